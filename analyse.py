@@ -1,37 +1,58 @@
 #!/usr/bin/python3
 
+import os
+import sys
 import pickle
+import multiprocessing
 
 from tkinter import filedialog
 from tkinter import *
 
 import numpy as np
-from scipy.stats import gaussian_kde
 
 import matplotlib.pyplot as plt
 
 from shapely.geometry import Point, LineString
 from shapely.geometry.polygon import Polygon
 
+import tracer
+import store
+from histograms import exit_angles, scatter_angles, joint_counts, smoothed_density
+
 
 def load_data(fname):
+    """Load a store run (its directory or meta.json), or an old whole-run pickle."""
+    if os.path.isdir(fname) or os.path.basename(fname) == "meta.json":
+        return store.load_run(fname)
     with open(fname, "rb") as f:
         datadict = pickle.load(f)
     return datadict
 
 
+def plot_binned(counts, edges):
+    """Draw accumulated counts the way plt.hist(..., density=1) draws raw data."""
+    return plt.hist(edges[:-1], edges, weights=counts, density=1, facecolor='blue', alpha=0.5)
+
+
 def present_data(data):
+    # runs with streamed histograms (histograms.Histograms) plot from those
+    hists = data.get("hists")
+    # weighted runs (fluorotrace3.run_trial) weight every ray
+    weights = data.get("weight")
 
     ### LOCATION HIST
     try:
         print("LOCATION HIST PLOT")
-        endpoints = data["ends"]
         plt.figure()
-        ends = [e[1] for e in endpoints]
-
-        num_bins = 300
-        # the histogram of the data
-        n, bins, patches = plt.hist(ends, num_bins, density=1, facecolor='blue', alpha=0.5)
+        if hists is not None:
+            plot_binned(hists.counts["pos"], hists.edges["pos"])
+        else:
+            endpoints = data["ends"]
+            ends = [e[1] for e in endpoints]
+
+            num_bins = 300
+            # the histogram of the data
+            n, bins, patches = plt.hist(ends, num_bins, weights=weights, density=1, facecolor='blue', alpha=0.5)
         plt.xlabel("Position")
         plt.ylabel("Freq.")
         plt.title("Detector POSITION histogram")
@@ -45,10 +66,13 @@ def present_data(data):
         print("OPL HIST PLOT")
         opls = data["opls"]
         plt.figure()
-
-        num_bins = 1000
-        # the histogram of the data
-        n, bins, patches = plt.hist(opls, num_bins, density=1, facecolor='blue', alpha=0.5)
+        if hists is not None:
+            plot_binned(hists.counts["opl"], hists.edges["opl"])
+            plt.xlim(hists.opl_min, hists.opl_max)
+        else:
+            num_bins = 1000
+            # the histogram of the data
+            n, bins, patches = plt.hist(opls, num_bins, weights=weights, density=1, facecolor='blue', alpha=0.5)
         plt.xlabel("OPL")
         plt.ylabel("Freq.")
         plt.title("Detector OPTICAL PATH LENGTH histogram")
@@ -57,8 +81,12 @@ def present_data(data):
         print(e)
 
     try:
-        print("MEAN OPL:", np.mean(opls))
-        print("MAX/MIN OPL:", max(opls), min(opls))
+        if hists is not None:
+            print("MEAN OPL:", hists.mean_opl())
+            print("MAX/MIN OPL:", hists.opl_max, hists.opl_min)
+        else:
+            print("MEAN OPL:", np.average(opls, weights=weights))
+            print("MAX/MIN OPL:", np.max(opls), np.min(opls))
     except Exception as e:
         print(e)
 
@@ -66,22 +94,15 @@ def present_data(data):
     ### EXIT ANGLE HIST
     try:
         print("EXIT ANGLE HIST PLOT")
-        enddirs = data["dir"]
         plt.figure()
-
-        num_bins = 300
-        # the histogram of the data
-        angles = []
-        wall_normal = [1,0,0]
-        for d in enddirs:
-            angle = np.arccos(np.dot(d,wall_normal))/ (np.linalg.norm(d) * np.linalg.norm(wall_normal))
-            angle = -np.pi/2 + np.abs(angle)
-            angle = (angle + np.pi) % (2 * np.pi) - np.pi
-            angle = 180 * angle / np.pi
-            angles.append(angle)
-            angles.append(-angle)
-
-        n, bins, patches = plt.hist(angles, num_bins, density=1, facecolor='blue', alpha=0.5)
+        if hists is not None:
+            plot_binned(hists.counts["angle"], hists.edges["angle"])
+        else:
+            num_bins = 300
+            # the histogram of the data, each exit angle and its mirror image
+            angles = exit_angles(data["dir"])
+            angles = np.concatenate([angles, -angles])
+            n, bins, patches = plt.hist(angles, num_bins, weights=None if weights is None else np.tile(weights, 2), density=1, facecolor='blue', alpha=0.5)
         plt.xlabel("Angle of exit (yz plane) (Degrees)")
         plt.ylabel("Freq.")
         plt.title("Detector EXIT ANGLE histogram")
@@ -90,47 +111,29 @@ def present_data(data):
         print(e)
 
 
-    ### EXIT ANGLE vs PATH LENGTH SCATTER 3D
+    ### EXIT ANGLE vs PATH LENGTH DENSITY
     try:
-        print("EXIT ANGLE PATH LENGTH SCATTER PLOT")
-        enddirs = data["dir"]
-        opls = data["opls"]
-        print(len(enddirs),len(opls),"xxxxxxxxxxxxxxxxx")
+        print("EXIT ANGLE PATH LENGTH DENSITY PLOT")
+        if hists is not None:
+            angle_edges, opl_edges = hists.edges["joint_angle"], hists.edges["joint_opl"]
+            joint = hists.counts["joint"]
+            opl_range = (hists.opl_min, hists.opl_max)
+        else:
+            # every ray, binned a chunk at a time
+            opls = data["opls"]
+            opl_range = (np.min(opls), np.max(opls))
+            angle_edges = np.linspace(0, 90, 181)
+            opl_edges = np.linspace(opl_range[0], opl_range[1] + 1e-9, 1001)
+            joint = joint_counts(data["dir"], opls, angle_edges, opl_edges, weights=weights)
         plt.figure()
-        # the histogram of the data
-        angles_safe = []
-        opls_safe = []
-        wall_normal = [1,0,0]
-        numgood = 0
-        for d, opl in zip(enddirs, opls):
-            angle = np.arccos(np.dot(d,wall_normal))/ (np.linalg.norm(d) * np.linalg.norm(wall_normal))
-            angle = np.abs(180 * (-np.pi/2 + angle) /np.pi)
-            if angle == 90:
-                angle = 0
-            if angle >= 0:
-                angles_safe.append(angle)
-                opls_safe.append(opl)
-                numgood += 1
-            if numgood > 15000:
-                break
-
-
-        # Calculate the point density
-        x = angles_safe
-        y = opls_safe
-        xy = np.vstack([x,y])
-        z = gaussian_kde(xy)(xy)
-
-        # Sort the points by density, so that the densest points are plotted last
-        idx = z.argsort()
-
-        x, y, z = [x[i] for i in idx], [y[i] for i in idx], [z[i] for i in idx]
-
-        plt.scatter(x, y, c=z, s=50, edgecolor='')
-
+        density = smoothed_density(joint, angle_edges, opl_edges)
+        density = np.ma.masked_less_equal(density, 1e-4 * density.max())
+        plt.pcolormesh(angle_edges, opl_edges, density.T)
+        plt.colorbar(label="Density")
+        plt.ylim(*opl_range)
         plt.xlabel("Angle of exit (yz plane) (Degrees)")
         plt.ylabel("OPL")
-        plt.title("Exit angle vs OPL")
+        plt.title("Exit angle vs OPL (" + "{:.6g}".format(joint.sum()) + " rays)")
         plt.grid()
     except Exception as e:
         print(e)
@@ -139,8 +142,12 @@ def present_data(data):
 
     ### GEOMETRY
     try:
-        print("MEAN OPL:", np.mean(opls))
-        print("MAX/MIN OPL:", max(opls), min(opls))
+        if hists is not None:
+            print("MEAN OPL:", hists.mean_opl())
+            print("MAX/MIN OPL:", hists.opl_max, hists.opl_min)
+        else:
+            print("MEAN OPL:", np.average(opls, weights=weights))
+            print("MAX/MIN OPL:", np.max(opls), np.min(opls))
     except Exception as e:
         print(e)
 
@@ -151,11 +158,19 @@ def present_data(data):
         tiles = stage["raypoints"]
         print("Number of raypoints:", len(tiles))
         plt.scatter([t[0] for t in tiles], [t[1] for t in tiles])
-        plt.plot(*stage["polygon"].exterior.xy, color="green", linewidth=2);
-        for e in stage["edges"]:
-            edge = stage["edges"][e]
-            if edge["type"] == "detector":
-                plt.plot([edge["from"][0], edge["to"][0]], [edge["from"][1], edge["to"][1]], color="red", linewidth = 3)
+        if "polygon" in stage:
+            plt.plot(*stage["polygon"].exterior.xy, color="green", linewidth=2);
+            for e in stage["edges"]:
+                edge = stage["edges"][e]
+                if edge["type"] == "detector":
+                    plt.plot([edge["from"][0], edge["to"][0]], [edge["from"][1], edge["to"][1]], color="red", linewidth = 3)
+        else:
+            cstage = tracer.unpack_stage(stage["compiled"])
+            outline = tracer.outline(cstage)
+            plt.plot(outline[:, 0], outline[:, 1], color="green", linewidth=2);
+            for i in np.flatnonzero(cstage["type"] == tracer.DETECTOR):
+                pts = tracer.edge_points(cstage, i)
+                plt.plot(pts[:, 0], pts[:, 1], color="red", linewidth = 3)
         plt.title("Geometry of " + stage["name"] + " concentrator\n zwalls=" + str(stage["zwalls"]) + ", " + str(stage["numradials"]) + " rays per point")
         plt.show()
         exit()
@@ -166,15 +181,126 @@ def present_data(data):
     plt.show()
 
 
+def run_group(run):
+    """
+    Label of the experiment a run from store.index_runs belongs to: its
+    shape, z walls, step size, sampling and whether it was weighted. Runs
+    are only totalled together with runs of the same experiment.
+    """
+    meta = run["meta"] or {}
+    params = meta.get("params") or {}
+    label = run["name"]
+    if run["zwalls"] is not None:
+        label += " z={:g}-{:g}".format(*run["zwalls"])
+    if params.get("step_size") is not None:
+        label += " dl={:g}".format(params["step_size"])
+    if meta.get("sampling"):
+        label += " {points}/{dirs}".format(**meta["sampling"])
+    if params.get("weighted"):
+        label += " weighted"
+    return label
+
+
+def run_totals(run):
+    """
+    Mergeable totals of one run from store.index_runs (detected rays, OPL and
+    exit angle sums, OPL range), streamed a chunk of rays at a time. Runs
+    saved with histograms only are totalled from those. Weighted runs are
+    totalled by weight.
+    """
+    meta = run["meta"] or {}
+    totals = {"name":run["name"], "group":run_group(run), "weighted":bool((meta.get("params") or {}).get("weighted")), "runs":1, "incomplete":int(not run["complete"]),
+              "rays":(meta.get("counts") or {}).get("rays"),
+              "detected":0, "opl_sum":0.0, "opl_sq":0.0, "angle_sum":0.0, "opl_min":np.inf, "opl_max":-np.inf}
+    if run["rows"] == 0 and meta.get("hists"):
+        hists = store.load_run(run["path"])["hists"]
+        opl_mid = 0.5 * (hists.edges["opl"][1:] + hists.edges["opl"][:-1])
+        angle_mid = 0.5 * (hists.edges["joint_angle"][1:] + hists.edges["joint_angle"][:-1])
+        totals.update(detected=hists.n, opl_sum=hists.opl_sum, opl_min=hists.opl_min, opl_max=hists.opl_max,
+                      opl_sq=float(np.sum(hists.counts["opl"] * opl_mid ** 2)),
+                      angle_sum=float(np.sum(hists.counts["joint"].sum(axis=1) * angle_mid)))
+        return totals
+    weighted = "weight" in meta.get("fields", {})
+    for cols in store.iter_columns(run, ("opls", "dir", "weight") if weighted else ("opls", "dir")):
+        opls = cols["opls"]
+        if not len(opls):
+            continue
+        w = cols["weight"].ravel() if weighted else np.ones(len(opls))
+        totals["detected"] += float(w.sum()) if weighted else len(opls)
+        totals["opl_sum"] += float(np.dot(w, opls))
+        totals["opl_sq"] += float(np.dot(w, opls ** 2))
+        totals["angle_sum"] += float(np.dot(w, scatter_angles(cols["dir"])))
+        totals["opl_min"] = min(totals["opl_min"], float(opls.min()))
+        totals["opl_max"] = max(totals["opl_max"], float(opls.max()))
+    return totals
+
+
+def merge_totals(total, part):
+    if total is None:
+        return dict(part)
+    for k in ("runs", "incomplete", "detected", "opl_sum", "opl_sq", "angle_sum"):
+        total[k] += part[k]
+    # the efficiency is only known if every run counted its rays
+    total["rays"] = None if total["rays"] is None or part["rays"] is None else total["rays"] + part["rays"]
+    total["opl_min"] = min(total["opl_min"], part["opl_min"])
+    total["opl_max"] = max(total["opl_max"], part["opl_max"])
+    return total
+
+
+def summary(totals):
+    n = totals["detected"]
+    mean = totals["opl_sum"] / n if n else np.nan
+    return {"runs":totals["runs"], "incomplete":totals["incomplete"], "rays":totals["rays"], "detected":n,
+            "efficiency":n / totals["rays"] if totals["rays"] else np.nan,
+            "mean_opl":mean, "std_opl":np.sqrt(max(totals["opl_sq"] / n - mean ** 2, 0)) if n else np.nan,
+            "min_opl":totals["opl_min"] if n else np.nan, "max_opl":totals["opl_max"] if n else np.nan,
+            "mean_exit_angle":totals["angle_sum"] / n if n else np.nan}
+
+
+def summarise_runs(root="./data", workers=None):
+    """
+    Summaries of every run in root per experiment (see run_group), and
+    overall ("ALL", and "ALL weighted" for weighted runs, which are never
+    totalled with unweighted ones), totalled by a pool of workers, each
+    streaming one run at a time.
+    """
+    runs = store.index_runs(root)
+    groups, overall = {}, {}
+    with multiprocessing.Pool(workers) as pool:
+        for totals in pool.imap_unordered(run_totals, runs):
+            groups[totals["group"]] = merge_totals(groups.get(totals["group"]), totals)
+            label = "ALL weighted" if totals["weighted"] else "ALL"
+            overall[label] = merge_totals(overall.get(label), totals)
+    return {label:summary(t) for label, t in sorted(groups.items())}, {label:summary(t) for label, t in sorted(overall.items())}
+
+
+def print_summaries(groups, overall):
+    cols = ["runs", "rays", "detected", "efficiency", "mean_opl", "std_opl", "min_opl", "max_opl", "mean_exit_angle"]
+    rows = list(groups.items()) + list(overall.items())
+    width = max([len("experiment")] + [len(label) for label, s in rows]) + 2
+    print("experiment".rjust(width) + "".join("{:>16}".format(c) for c in cols))
+    for label, s in rows:
+        print(label.rjust(width) + "".join("{:>16}".format("-" if s[c] is None else "{:.6g}".format(s[c])) for c in cols)
+              + (" ({} incomplete)".format(s["incomplete"]) if s["incomplete"] else ""))
+
+
 def main():
-    root = Tk()
-    root.withdraw()
-    fname = filedialog.askopenfilename(initialdir = "./data/",title = "Select file",filetypes = (("pickle files","*.pickle"),("all files","*.*")))
-    root.destroy()
+    # a directory of runs is summarised, one run (or none given, pick one) is plotted
+    if len(sys.argv) > 1 and os.path.isdir(sys.argv[1]) and not os.path.exists(os.path.join(sys.argv[1], "meta.json")):
+        print_summaries(*summarise_runs(sys.argv[1]))
+        return
+    if len(sys.argv) > 1:
+        fname = sys.argv[1]
+    else:
+        root = Tk()
+        root.withdraw()
+        fname = filedialog.askopenfilename(initialdir = "./data/",title = "Select file",filetypes = (("run headers","meta.json"),("pickle files","*.pickle"),("all files","*.*")))
+        root.destroy()
 
     data = load_data(fname)
     print(data.keys())
     present_data(data)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import resource
+import tempfile
+import datetime
+import contextlib
+import subprocess
+import traceback
+import multiprocessing
+
+from queue import Empty
+
+import numpy as np
+from scipy.stats import ks_2samp
+
+import fluorotrace3
+import parallel_fluorotrace3
+import sampling
+import store
+
+# the workloads are every combination of these, each run with the same seed
+SHAPES = ["rectangle", "angled", "semicircle", "triangle1"]
+ENGINES = ["scalar", "batch", "exact", "unfolded"]
+STEP_SIZES = [0.01, 0.005]
+RAYS = [(20, 100)] # (num_raypoints, num_radials)
+WORKERS = [1, 2]
+ZWALLS = (0, 0.1)
+MAX_STEPS = 10000
+SEED = 1234
+
+# reference run per shape, with the exact tracer and its own seed
+REFERENCE_RAYS = (100, 200)
+REFERENCE_SEED = 4321
+
+# tile chunks a run is saved in: the rays of one tile share their origin, so the standard errors
+# of the agreement with the reference come from the chunk totals (sampling.run_errors), not single rays
+BATCHES = 20
+
+RESULTS_FILE = "./benchmarks.jsonl"
+
+
+def workloads(shapes=SHAPES, engines=ENGINES, step_sizes=STEP_SIZES, rays=RAYS, workers=WORKERS):
+    for shape in shapes:
+        for engine in engines:
+            # the event driven engines have no step, the size only sets their OPL cut off
+            for step_size in (step_sizes if engine in ("scalar", "batch") else step_sizes[:1]):
+                for num_raypoints, num_radials in rays:
+                    for w in workers:
+                        yield {"shape":shape, "engine":engine, "step_size":step_size, "num_raypoints":num_raypoints,
+                               "num_radials":num_radials, "workers":w, "zwalls":list(ZWALLS), "max_steps":MAX_STEPS, "seed":SEED}
+
+
+def workload_key(w):
+    return tuple(sorted((k, str(v)) for k, v in w.items()))
+
+
+def peak_rss_mb(workers=0):
+    """
+    Peak resident set of this process plus that of its workers pool workers,
+    in MB. Only the largest peak of any finished (reaped) child is known, so
+    each worker is taken to have that one, and pages they share with this
+    process are counted again for each: an upper bound.
+    """
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return (self_rss + workers * child_rss) / 1024
+
+
+def trace(w):
+    """
+    Run one workload into a scratch store run, in BATCHES tile chunks (or
+    pool tasks), returning (seconds, counts, opls, errors), the errors from
+    sampling.run_errors.
+    """
+    chunk = max(1, w["num_raypoints"] // BATCHES)
+    start = time.perf_counter()
+    if w["workers"] == 1:
+        stage = fluorotrace3.get_stage(shape=w["shape"], zwalls=tuple(w["zwalls"]))
+        fluorotrace3.add_raypoints(stage, num_raypoints=w["num_raypoints"], num_radials=w["num_radials"], seed=w["seed"])
+        start = time.perf_counter()
+        path = fluorotrace3.trial_to_store(stage, step_size=w["step_size"], max_steps=w["max_steps"], engine=w["engine"], batch_tiles=chunk,
+                                           histogram=False, use_progbar=False)
+    else:
+        path = parallel_fluorotrace3.run_shapes([w["shape"]], num_raypoints=w["num_raypoints"], num_radials=w["num_radials"],
+                                                max_steps=w["max_steps"], zwalls=tuple(w["zwalls"]), step_size=w["step_size"],
+                                                engine=w["engine"], batch_tiles=10, tiles_per_task=chunk, workers=w["workers"],
+                                                histogram=False, seed=w["seed"], live=False)[w["shape"]]
+    seconds = time.perf_counter() - start
+    data = store.load_run(path, mmap=False)
+    return seconds, data["meta"]["counts"], np.array(data["opls"]), sampling.run_errors(path)
+
+
+def summary(counts, opls, errors):
+    return {"rays":counts["rays"], "detected":len(opls), "efficiency":len(opls) / counts["rays"], "efficiency_err":float(errors["efficiency_err"]),
+            "mean_opl":float(np.mean(opls)) if len(opls) else None, "mean_opl_err":float(errors["mean_opl_err"]),
+            "std_opl":float(np.std(opls)) if len(opls) else None}
+
+
+def agreement(result, ref, opls, ref_opls):
+    """
+    z scores of the efficiency and mean OPL differences from the reference,
+    with the standard errors of both from their chunk totals, and a KS test
+    of the OPLs (which takes the rays as independent, so its p is too small).
+    """
+    agree = {}
+    for k in ("efficiency", "mean_opl"):
+        se = np.hypot(result[k + "_err"], ref[k + "_err"]) if result[k] is not None and ref[k] is not None else np.nan
+        agree[k + "_z"] = float((result[k] - ref[k]) / se) if np.isfinite(se) and se > 0 else None
+    if len(opls) > 1 and len(ref_opls) > 1:
+        ks = ks_2samp(opls, ref_opls)
+        agree.update({"ks_stat":float(ks.statistic), "ks_p":float(ks.pvalue)})
+    return agree
+
+
+def run_in_child(w, queue):
+    scratch = tempfile.mkdtemp(prefix="fluorotrace-bench-")
+    try:
+        os.chdir(scratch)
+        os.makedirs("data")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            seconds, counts, opls, errors = trace(w)
+        # the pool is kept warm, its workers are only counted once they have been reaped
+        parallel_fluorotrace3.close_pool()
+        queue.put((seconds, counts, opls, errors, peak_rss_mb(w["workers"] if w["workers"] > 1 else 0)))
+    except BaseException:
+        queue.put(RuntimeError("Workload " + str(w) + " failed:\n" + traceback.format_exc()))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def measure(w):
+    """
+    Run a workload in a fresh process, so its peak memory is its own.
+    Raises RuntimeError if it fails, or its process dies.
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run_in_child, args=(w, queue))
+    proc.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not proc.is_alive() and queue.empty():
+                raise RuntimeError("Workload " + str(w) + " died with exit code " + str(proc.exitcode))
+    proc.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"host":socket.gethostname(), "platform":platform.platform(), "python":platform.python_version(),
+            "numpy":np.__version__, "cpus":os.cpu_count(), "commit":commit or None}
+
+
+def record(w, seconds, counts, opls, errors, rss, ref, ref_opls, env):
+    result = summary(counts, opls, errors)
+    steps = counts.get("steps", 0)
+    return dict(env, time=datetime.datetime.now().isoformat(), workload=w, seconds=seconds,
+                rays_per_s=counts["rays"] / seconds, steps=steps, ns_per_step=1e9 * seconds / steps if steps else None,
+                peak_rss_mb=rss, result=result, reference=ref, agreement=agreement(result, ref, opls, ref_opls))
+
+
+def run(ws, fname=RESULTS_FILE):
+    """Run the workloads ws, printing and appending a record per workload to fname."""
+    env = environment()
+    refs, records = {}, []
+    for w in ws:
+        if w["shape"] not in refs:
+            ref_w = dict(w, engine="exact", workers=1, num_raypoints=REFERENCE_RAYS[0], num_radials=REFERENCE_RAYS[1], seed=REFERENCE_SEED)
+            seconds, counts, ref_opls, errors, rss = measure(ref_w)
+            refs[w["shape"]] = (dict(summary(counts, ref_opls, errors), workload=ref_w), ref_opls)
+        ref, ref_opls = refs[w["shape"]]
+        seconds, counts, opls, errors, rss = measure(w)
+        rec = record(w, seconds, counts, opls, errors, rss, ref, ref_opls, env)
+        records.append(rec)
+        print("{shape:>10} {engine:>8} dl={step_size:<6} {num_raypoints}x{num_radials} x{workers}:".format(**w),
+              "{:10.0f} rays/s".format(rec["rays_per_s"]),
+              "{:8.1f} ns/step".format(rec["ns_per_step"]) if rec["ns_per_step"] else " " * 16,
+              "{:7.1f} MB".format(rss),
+              "efficiency z {:+.2f}".format(rec["agreement"]["efficiency_z"]) if rec["agreement"]["efficiency_z"] is not None else "")
+        with open(fname, "a") as f:
+            f.write(json.dumps(rec) + "\n")
+    return records
+
+
+def load(fname):
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(old_fname, new_fname, slower=0.9, z=3):
+    """
+    Print the throughput of each workload in new_fname against its latest
+    record in old_fname, flagging those under slower times as fast, and any
+    that disagree with their reference by more than z standard errors.
+    """
+    old = {workload_key(r["workload"]):r for r in load(old_fname)}
+    for rec in load(new_fname):
+        w = rec["workload"]
+        flags = []
+        prev = old.get(workload_key(w))
+        ratio = rec["rays_per_s"] / prev["rays_per_s"] if prev else None
+        if ratio is not None and ratio < slower:
+            flags.append("SLOWER")
+        agree = rec["agreement"]
+        if abs(agree.get("efficiency_z") or 0) > z or abs(agree.get("mean_opl_z") or 0) > z:
+            flags.append("DISAGREES")
+        print("{shape:>10} {engine:>8} dl={step_size:<6} {num_raypoints}x{num_radials} x{workers}:".format(**w),
+              "{:10.0f} rays/s".format(rec["rays_per_s"]),
+              "{:6.2f}x".format(ratio) if ratio is not None else "   new ",
+              " ".join(flags))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        compare(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) > 1 and sys.argv[1] == "quick":
+        run(workloads(shapes=SHAPES[:1], step_sizes=STEP_SIZES[:1], workers=WORKERS[:1]))
+    else:
+        run(workloads(), fname=sys.argv[1] if len(sys.argv) > 1 else RESULTS_FILE)
+
+
+if __name__ == "__main__":
+    main()
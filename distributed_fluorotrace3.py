@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import pickle
+import socket
+import threading
+import traceback
+import multiprocessing
+
+import numpy as np
+
+import telemetry
+import parallel_fluorotrace3
+
+# a task whose lease has not been renewed for this long is handed to another worker
+LEASE_TIMEOUT = 60.0
+HEARTBEAT = LEASE_TIMEOUT / 4
+POLL = 0.2
+
+
+class TaskFailed(Exception):
+    """A task raised on its worker; the message has the worker's traceback."""
+
+
+class TaskQueue:
+    """
+    Task queue in a directory that the coordinator and every worker can
+    see (a shared file system, or a local directory on one machine). A task
+    is a pickle in tasks/, and a worker claims it by renaming it into
+    leases/, which only one worker can do. While it runs the task the
+    worker touches its lease. The coordinator puts leases that have not
+    been touched for LEASE_TIMEOUT back in tasks/, so the task of a worker
+    that died is run again. Outputs are written to results/ and renamed into
+    place, so a result file is always whole. Each worker also keeps its
+    telemetry.COUNTERS in telemetry/, rewritten every telemetry.INTERVAL.
+    Only one run uses a queue directory at a time.
+    """
+    def __init__(self, path):
+        self.path = path
+        for d in ("tasks", "leases", "results", "telemetry"):
+            os.makedirs(os.path.join(path, d), exist_ok=True)
+
+    def file(self, d, name):
+        return os.path.join(self.path, d, name)
+
+    def reset(self):
+        """Empty the queue of anything a previous run left, and reopen it."""
+        for d in ("tasks", "leases", "results", "telemetry"):
+            for fname in os.listdir(os.path.join(self.path, d)):
+                os.remove(self.file(d, fname))
+        if os.path.exists(os.path.join(self.path, "closed")):
+            os.remove(os.path.join(self.path, "closed"))
+
+    def write(self, d, name, obj):
+        tmp = self.file(d, "." + name + ".tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(obj, f)
+        os.replace(tmp, self.file(d, name))
+
+    def put(self, task_id, task):
+        self.write("tasks", task_id + ".pickle", task)
+
+    def claim(self):
+        """Take the next task, returning (task id, task), or None if there are none."""
+        for fname in sorted(os.listdir(os.path.join(self.path, "tasks"))):
+            if fname.startswith("."):
+                continue
+            try:
+                os.rename(self.file("tasks", fname), self.file("leases", fname))
+                # a rename keeps the time the task was put, the lease starts now
+                os.utime(self.file("leases", fname))
+                with open(self.file("leases", fname), "rb") as f:
+                    return fname[:-7], pickle.load(f)
+            except FileNotFoundError:
+                # another worker got there first, or our lease has already run out
+                continue
+        return None
+
+    def renew(self, task_id):
+        try:
+            os.utime(self.file("leases", task_id + ".pickle"))
+        except FileNotFoundError:
+            pass
+
+    def finish(self, task_id, output, worker):
+        self.write("results", task_id + "@" + worker + ".pickle", output)
+        self.forget(task_id)
+
+    def forget(self, task_id):
+        # a task can be both leased and back in tasks/ if its lease ran out before it finished
+        for d in ("leases", "tasks"):
+            try:
+                os.remove(self.file(d, task_id + ".pickle"))
+            except FileNotFoundError:
+                pass
+
+    def results(self):
+        """Take the outputs written so far, as (task id, output)."""
+        for fname in sorted(os.listdir(os.path.join(self.path, "results"))):
+            if fname.startswith("."):
+                continue
+            with open(self.file("results", fname), "rb") as f:
+                output = pickle.load(f)
+            os.remove(self.file("results", fname))
+            task_id = fname.split("@")[0]
+            self.forget(task_id)
+            yield task_id, output
+
+    def publish_counters(self, worker, row):
+        self.write("telemetry", worker + ".pickle", [float(v) for v in row])
+
+    def counters(self):
+        """The telemetry.COUNTERS row of every worker that has published one, by worker name."""
+        rows = {}
+        for fname in os.listdir(os.path.join(self.path, "telemetry")):
+            if fname.startswith("."):
+                continue
+            try:
+                with open(self.file("telemetry", fname), "rb") as f:
+                    rows[fname[:-7]] = pickle.load(f)
+            except FileNotFoundError:
+                continue
+        return rows
+
+    def leased(self):
+        return [fname[:-7] for fname in os.listdir(os.path.join(self.path, "leases")) if not fname.startswith(".")]
+
+    def requeue_expired(self, timeout=LEASE_TIMEOUT):
+        """Put back the tasks whose leases have run out, returning their ids."""
+        now, ids = time.time(), []
+        for fname in os.listdir(os.path.join(self.path, "leases")):
+            try:
+                if now - os.path.getmtime(self.file("leases", fname)) > timeout:
+                    os.rename(self.file("leases", fname), self.file("tasks", fname))
+                    ids.append(fname[:-7])
+            except FileNotFoundError:
+                continue
+        return ids
+
+    def drop(self, task_ids):
+        """Take back the tasks of task_ids no worker has claimed, returning their ids."""
+        dropped = []
+        for task_id in task_ids:
+            try:
+                os.remove(self.file("tasks", task_id + ".pickle"))
+                dropped.append(task_id)
+            except FileNotFoundError:
+                continue
+        return dropped
+
+    def close(self):
+        open(os.path.join(self.path, "closed"), "w").close()
+
+    def closed(self):
+        return os.path.exists(os.path.join(self.path, "closed"))
+
+
+def worker_name():
+    return socket.gethostname() + "-" + str(os.getpid())
+
+
+def serve(path, idle=None):
+    """
+    Run tasks from the queue directory path until its run is over, or no
+    task has come for idle seconds (if given). Start one per core on each
+    node, with python3 distributed_fluorotrace3.py path. Progress goes to
+    the queue's telemetry, not the console.
+    """
+    queue, name = TaskQueue(path), worker_name()
+    counters = np.zeros(len(telemetry.COUNTERS))
+    parallel_fluorotrace3.init_counters(counters)
+    last = time.time()
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            if queue.closed() or (idle is not None and time.time() - last > idle):
+                return
+            time.sleep(POLL)
+            continue
+        tid, task = claimed
+        done = threading.Event()
+
+        def heartbeat():
+            renewed = time.time()
+            while not done.wait(telemetry.INTERVAL):
+                queue.publish_counters(name, counters)
+                if time.time() - renewed >= HEARTBEAT:
+                    queue.renew(tid)
+                    renewed = time.time()
+
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            output = parallel_fluorotrace3.run_task(task)
+        except Exception:
+            # given as the task's output, so the run fails rather than the task going round the workers
+            output = TaskFailed("Task " + tid + " failed on " + name + ":\n" + traceback.format_exc())
+        finally:
+            done.set()
+            beat.join()
+        queue.publish_counters(name, counters)
+        queue.finish(tid, output, name)
+        last = time.time()
+
+
+def publish(path, tasks, workers=0, lease_timeout=None):
+    """
+    Put tasks (from parallel_fluorotrace3.make_tasks) in the queue directory
+    path and start workers local worker processes on it. Returns the run_task
+    outputs, as an iterator that waits for them all, and the stop(shape)
+    callback of parallel_fluorotrace3.merge_tasks, which takes back the
+    shape's unclaimed tasks and gives them as skipped. The iterator raises
+    TaskFailed if a task raised on its worker, and RuntimeError if the
+    local workers have all died with tasks left that no other worker has
+    taken for a lease timeout.
+    """
+    queue = TaskQueue(path)
+    queue.reset()
+    # workers claim tasks in file name order, which keeps the order of tasks
+    by_id = {"{:06d}-{}-{}".format(i, t["shape"], t["index"]):t for i, t in enumerate(tasks)}
+    for tid, task in by_id.items():
+        queue.put(tid, task)
+    local = [multiprocessing.Process(target=serve, args=(path,), daemon=True) for _ in range(workers)]
+    for proc in local:
+        proc.start()
+    pending, skipped = set(by_id), []
+    timeout = lease_timeout or LEASE_TIMEOUT
+
+    def stop(shape):
+        for tid in queue.drop([tid for tid in pending if by_id[tid]["shape"] == shape]):
+            pending.discard(tid)
+            skipped.append((shape, by_id[tid]["index"], None, None, None, None, None))
+
+    def outputs():
+        last = time.time()
+        try:
+            while pending or skipped:
+                while skipped:
+                    yield skipped.pop()
+                got = False
+                for tid, output in queue.results():
+                    if isinstance(output, TaskFailed):
+                        raise output
+                    # a task run twice, after its lease ran out, is only merged once
+                    if tid in pending:
+                        pending.discard(tid)
+                        got = True
+                        yield output
+                for tid in queue.requeue_expired(timeout):
+                    print("Lease of task", tid, "ran out, queued again")
+                if got or queue.leased() or not local or any(proc.is_alive() for proc in local):
+                    last = time.time()
+                elif time.time() - last > timeout:
+                    raise RuntimeError("Every local worker has died, and no other worker has taken a task of " + path)
+                if not got and pending:
+                    time.sleep(POLL)
+        finally:
+            queue.close()
+            for proc in local:
+                # a run that failed leaves tasks behind, that local workers need not finish
+                if pending:
+                    proc.terminate()
+                proc.join()
+
+    return outputs(), stop
+
+
+def main():
+    serve(sys.argv[1], idle=float(sys.argv[2]) if len(sys.argv) > 2 else None)
+
+
+if __name__ == "__main__":
+    main()
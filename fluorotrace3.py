@@ -1,34 +1,42 @@
 #!/usr/bin/python3
 
-import pickle
+import os
 import copy
+import time
 import random
-import datetime
+import functools
 
 import numpy as np
 
 from shapely.geometry import Point, LineString
 from shapely.geometry.polygon import Polygon
 
-import matplotlib.pyplot as plt
-from matplotlib import cm
-from mpl_toolkits.mplot3d import Axes3D
+# plotting, progress bars and the status light (lux) are imported where they are used,
+# so pool workers and scripts that only trace stay quick to start and need no display
 
-import progressbar
 import geometry
-import lux
+import tracer
+import store
+import histograms
+import sampling
+import instrument
 
 N1 = 1.492 # acrylic?
 N2 = 1.00027 # air at STP
 CRIT_ANGLE = np.arcsin(N2/N1)
 print("Assuming Critical Angle", "{:0.3f}".format(CRIT_ANGLE * 180/np.pi), "Deg")
 
+# pool workers set this to a function taking the rays their trial has traced so far, called as each tile
+# chunk finishes; they then print no TILE lines, as their parent shows them all at once (see telemetry)
+ON_CHUNK = None
+
 
 def get_stage(shape="rectangle", zwalls=(0,1)):
     print("Building Stage for",shape,"...")
-    nodes, edge_types = geometry.get_shape(shape)
+    nodes, edge_types, bulges = geometry.get_shape(shape)
 
-    poly = Polygon([n for n in nodes])
+    # a stage with arcs gets its polygon once it is compiled, below
+    poly = Polygon([n for n in nodes]) if not any(bulges) else None
     stage = {"name":shape,
         "polygon":poly,
         "zwalls":zwalls,
@@ -55,8 +63,16 @@ def get_stage(shape="rectangle", zwalls=(0,1)):
         else:
             raise Exception
         #print(edge1, edge2)
-        stage["edges"][i] = {"from":edge1, "to":edge2, "dir":np.array([dy, -dx, 0]), "line":LineString([edge1, edge2]), "type":t}
-
+        stage["edges"][i] = {"from":edge1, "to":edge2, "dir":np.array([dy, -dx, 0]), "line":LineString([edge1, edge2]), "type":t,
+                             "bulge":bulges[i]}
+
+    # array form of the stage (and its edge grid) for the tracers
+    stage["compiled"] = tracer.compile_stage(stage)
+    if stage["compiled"]["arcs"] is not None:
+        # the nodes alone miss the arcs, so outline and ranges come from the compiled stage
+        stage["polygon"] = Polygon(tracer.outline(stage["compiled"]))
+        lo, hi = tracer.stage_bounds(stage["compiled"])
+        stage["xrange"], stage["yrange"] = [lo[0], hi[0]], [lo[1], hi[1]]
     return stage
 
 
@@ -76,22 +92,36 @@ def rotation_matrix(axis, theta):
                      [2 * (bd + ac), 2 * (cd - ab), aa + dd - bb - cc]])
 
 
-def random_fibonacci_sphere(samples):
-    rnd = random.random()
-    rand_rot_mat = rotation_matrix([random.random(), random.random(), random.random()], 2*np.pi*random.random())
-    points = []
+@functools.lru_cache(maxsize=16)
+def fibonacci_lattice(samples):
+    """The unrotated Fibonacci lattice of samples points on the unit sphere, as a read only (samples, 3) array."""
     offset = 2./samples
-    increment = np.pi * (3. - np.sqrt(5.));
+    increment = np.pi * (3. - np.sqrt(5.))
+    i = np.arange(samples)
+    y = ((i * offset) - 1) + (offset / 2)
+    r = np.sqrt(1 - y**2)
+    phi = i * increment
+    points = np.stack([np.cos(phi) * r, y, np.sin(phi) * r], axis=1)
+    points.flags.writeable = False
+    return points
 
-    for i in range(samples):
-        y = ((i * offset) - 1) + (offset / 2);
-        r = np.sqrt(1 - pow(y,2))
-        phi = ((i + rnd) % samples) * increment
-        x = np.cos(phi) * r
-        z = np.sin(phi) * r
-        points.append(np.dot(rand_rot_mat, [x,y,z]))
 
-    return points
+def fibonacci_rotation(rng=random):
+    """
+    The random rotation random_fibonacci_sphere applies to the lattice:
+    a random shift of the lattice along its spiral (a turn about y) and
+    then a rotation about a random axis.
+    """
+    increment = np.pi * (3. - np.sqrt(5.))
+    theta = rng.random() * increment
+    rand_rot_mat = rotation_matrix([rng.random(), rng.random(), rng.random()], 2*np.pi*rng.random())
+    c, s = np.cos(theta), np.sin(theta)
+    return np.dot(rand_rot_mat, np.array([[c, 0, -s], [0, 1, 0], [s, 0, c]]))
+
+
+def random_fibonacci_sphere(samples, rng=random):
+    """samples directions as a (samples, 3) array: the cached lattice, randomly rotated."""
+    return np.dot(fibonacci_lattice(samples), fibonacci_rotation(rng).T)
 
 
 def normalise(x):
@@ -119,22 +149,47 @@ def is_outside_crit_angle(ray, wall, crit_angle=np.pi/2):
     return True if angle > crit_angle else False
 
 
+def ray_state(status, ray, last, itercount, bounces, dl):
+    end, enddir = last[0], None
+    # a ray stuck bouncing between the z walls can end where it was two steps before
+    if last[2] is not None and np.any(last[0] != last[2]):
+        enddir = normalise(last[0] - last[2])
+    return {"status":status, "pos":ray[1], "dir":ray[0], "end":end, "enddir":enddir,
+            "opl":itercount * dl, "bounces":bounces, "pathlen":last[3]}
+
+
 #@profile
-def sim_ray(ray, stage, dl=0.1, max_steps=10000):
-    path, itercount, detected  = [], 0, False
+def trace_ray(ray, stage, dl=0.1, max_steps=10000, path=None, stats=None):
+    """
+    Path free core of sim_ray: returns the final state of the ray (position,
+    direction, OPL, bounce count and a tracer status code). Only the last
+    three positions are kept, unless a list is passed in as path, in which
+    case every position is appended to it. Counters go to stats (see
+    instrument.new_stats) if given.
+    """
+    last, itercount, bounces = [None, None, None, 0], 0, 0  # path[-1], path[-2], path[-3], len(path)
     minz, maxz = stage["zwalls"]
-    while not detected:
+    while True:
         if itercount > max_steps:
-            return None, None
+            return ray_state(tracer.MAX_STEPS, ray, last, itercount, bounces, dl)
+        if last[3] > tracer.MAX_PATH_FACTOR * (max_steps + 1):
+            instrument.add(stats, stuck=1)
+            return ray_state(tracer.MAX_STEPS, ray, last, itercount, bounces, dl)
         itercount += 1
         oldray = ray
-        path.append(oldray[1])
+        last = [oldray[1], last[0], last[1], last[3] + 1]
+        if path is not None:
+            path.append(oldray[1])
         ray = (ray[0], ray[1] + ray[0] * dl)
 
+        if stats is not None:
+            stats["contains"] += 1
         if not stage["polygon"].contains(Point(ray[1][0], ray[1][1])):
             ## find intersecting line...
             test_line = LineString([(ray[1][0], ray[1][1]), (oldray[1][0], oldray[1][1])])
-            for e in stage["edges"].keys():
+            for e in tracer.grid_segment_edges(stage["compiled"]["grid"], ray[1], oldray[1]):
+                if stats is not None:
+                    stats["edge_tests"] += 1
                 intersection = (stage["edges"][e]["line"].intersection(test_line))
                 if not intersection.is_empty:
                     do_reflect, ref = (True if stage["edges"][e]["type"] == "mirror" else False), e
@@ -142,42 +197,71 @@ def sim_ray(ray, stage, dl=0.1, max_steps=10000):
                     break
             else:
                 print("NO INTERSECTION ERROR")
-                return None, None
+                return ray_state(tracer.NO_INTERSECTION, ray, last, itercount, bounces, dl)
 
             if do_reflect:
                 itercount -= 1
                 wall = normalise(stage["edges"][ref]["dir"])
                 if is_outside_crit_angle(ray, wall, CRIT_ANGLE):
                     ray = (reflect(ray, wall), ray[1] - ray[0] * dl)
+                    bounces += 1
+                    if stats is not None:
+                        stats["reflect_edge"][ref] += 1
                 else:
-                    return None, None # Ray Exited
+                    return ray_state(tracer.ESCAPED_SIDE, ray, last, itercount, bounces, dl) # Ray Exited
             else:
                 if is_dump:
-                    return None, None # Ray has hit beam dump
-                return path, itercount * dl
+                    return ray_state(tracer.DUMPED, ray, last, itercount, bounces, dl) # Ray has hit beam dump
+                return ray_state(tracer.DETECTED, ray, last, itercount, bounces, dl)
 
         if ray[1][2] < minz:
             itercount -= 1
             wall = [0, 0, 1]
             if is_outside_crit_angle(ray, wall, CRIT_ANGLE):
                 ray = (reflect(ray, wall), ray[1] - ray[0] * dl)
+                bounces += 1
+                instrument.add(stats, reflect_z=1)
             else:
-                return None, None # Ray Exited
+                return ray_state(tracer.ESCAPED_Z, ray, last, itercount, bounces, dl) # Ray Exited
         elif ray[1][2] > maxz:
             itercount -= 1
             wall = [0, 0, -1]
             if is_outside_crit_angle(ray, wall, CRIT_ANGLE):
                 ray = (reflect(ray, wall), ray[1] - ray[0] * dl)
+                bounces += 1
+                instrument.add(stats, reflect_z=1)
             else:
-                return None, None # Ray Exited
+                return ray_state(tracer.ESCAPED_Z, ray, last, itercount, bounces, dl) # Ray Exited
+
+
+def sim_ray(ray, stage, dl=0.1, max_steps=10000):
+    path = []
+    state = trace_ray(ray, stage, dl=dl, max_steps=max_steps, path=path)
+    if state["status"] != tracer.DETECTED:
+        return None, None
+    return path, state["opl"]
 
 
-def add_raypoints(stage, num_raypoints=1000, num_radials=200):
+def add_raypoints(stage, num_raypoints=1000, num_radials=200, seed=None, points="random", dirs="fibonacci"):
+    """
+    Scatter num_raypoints tiles over the stage. Everything random in a run
+    comes from seed (a new one if None, kept in stage["seed"]): the tiles
+    here, and each tile's directions from its own stream (see tile_rng).
+    points and dirs pick how the tiles and each tile's directions are
+    sampled, from sampling.POINT_MODES and sampling.DIR_MODES.
+    """
+    if seed is None:
+        seed = random.getrandbits(63)
+    stage["seed"] = seed
+    stage["sampling"] = {"points":points, "dirs":dirs}
+    rng = random.Random("{}:{}:raypoints".format(seed, stage["name"]))
     raypoints, cnt = [], 0
+    if points != "random":
+        raypoints = sampling.volume_samples(num_raypoints, stage, mode=points, seed=rng.getrandbits(63)).tolist()
     while len(raypoints) < num_raypoints:
-        x = random.random()*(stage["xrange"][1]-stage["xrange"][0])+wstage["xrange"][0]
-        y = random.random()*(stage["yrange"][1]-stage["yrange"][0])+stage["yrange"][0]
-        z = random.random()*(stage["zrange"][1]-stage["zrange"][0])+stage["zrange"][0]
+        x = rng.random()*(stage["xrange"][1]-stage["xrange"][0])+stage["xrange"][0]
+        y = rng.random()*(stage["yrange"][1]-stage["yrange"][0])+stage["yrange"][0]
+        z = rng.random()*(stage["zrange"][1]-stage["zrange"][0])+stage["zrange"][0]
         if stage["polygon"].contains(Point(x, y)):
             raypoints.append([x, y, z])
 
@@ -186,23 +270,390 @@ def add_raypoints(stage, num_raypoints=1000, num_radials=200):
     print(stage["name"] + ":", len(raypoints), "RayPoints Added: ", len(raypoints) * num_radials, "rays to be traced")
 
 
-def run_trial(stage, show_single_trace=False, step_size=0.1, max_steps=10000,use_progbar=True):
+def tile_rng(stage, index):
+    """
+    Random stream for tile index of the stage, made from (seed, shape, tile
+    index) alone, so a tile gets the same rays whichever process traces it
+    and in whatever order. Stages without a seed use the global random.
+    """
+    if stage.get("seed") is None:
+        return random
+    return random.Random("{}:{}:{}".format(stage["seed"], stage["name"], index))
+
+
+def tile_raydirs(stage, index, count=1):
+    """
+    Directions of count tiles from tile index on, as a (count, numradials,
+    3) array. Fibonacci sets are one batched rotation of the cached lattice.
+    """
+    rngs = [tile_rng(stage, stage.get("first_tile", 0) + index + i) for i in range(count)]
+    mode = stage["sampling"]["dirs"] if "sampling" in stage else "fibonacci"
+    if mode == "fibonacci":
+        rots = np.array([fibonacci_rotation(rng) for rng in rngs])
+        return np.matmul(fibonacci_lattice(stage["numradials"]), rots.transpose(0, 2, 1))
+    return np.array([sampling.sphere_samples(stage["numradials"], mode=mode, seed=rng.getrandbits(63)) for rng in rngs])
+
+
+def new_counts(writer=None):
+    """Zeroed status counts, or those already committed to a reopened store.ResultWriter."""
+    if writer is not None and writer.meta["counts"] is not None:
+        return dict(writer.meta["counts"])
+    return dict({name:0 for name in tracer.STATUS_NAMES}, culled=0, rays=0, steps=0)
+
+
+def progress(iterable, use_progbar=True):
+    """iterable, with a progress bar if use_progbar."""
+    if not use_progbar:
+        return iterable
+    import progressbar
+    return progressbar.progressbar(iterable, redirect_stdout=False)
+
+
+def log_tile(stage, done, total):
+    """The TILE line, for processes that do not report their progress through ON_CHUNK."""
+    if ON_CHUNK is None:
+        print(stage["name"] + ": TILE", done, "/", total)
+
+
+def chunk_done(rays):
+    if ON_CHUNK is not None:
+        ON_CHUNK(rays)
+
+
+def new_stats(stage, writer=None):
+    """Zeroed instrument counters for the stage, or those already committed to a reopened store.ResultWriter."""
+    if writer is not None and writer.meta.get("stats"):
+        return instrument.merge(None, writer.meta["stats"])
+    return instrument.new_stats(len(stage["compiled"]["start"]))
+
+
+def count_status(stage, status, culled=0, steps=0, detected_weight=None):
+    """
+    Add the tracer status codes of a batch of rays (and any culled at
+    launch) to stage["counts"], with the number of march steps they took,
+    and for weighted rays the summed weight of those detected. Culled rays
+    are only counted as "culled": they are sure never to be detected, but
+    not all of them would have escaped through a z wall, so the other
+    losses are only comparable between runs with the same culling.
+    """
+    counts = stage["counts"]
+    if detected_weight is not None:
+        counts["detected_weight"] = counts.get("detected_weight", 0.0) + float(detected_weight)
+    counts["steps"] = counts.get("steps", 0) + int(steps)
+    for name, n in zip(tracer.STATUS_NAMES, np.bincount(np.atleast_1d(status).astype(int), minlength=len(tracer.STATUS_NAMES))):
+        counts[name] += int(n)
+    counts["culled"] += int(culled)
+    counts["rays"] += int(np.size(status) + culled)
+
+
+def launch_rays(stage, tiles, raydirs, step_size=0.1, engine="batch", cull_escapes=True):
+    """
+    Positions and directions of every direction in raydirs from every point
+    in tiles, leaving out (and returning the number of) the rays that can
+    only escape through the z walls, if cull_escapes.
+    """
+    pos = np.repeat(np.array(tiles, dtype=float), [len(r) for r in raydirs], axis=0)
+    dirs = np.concatenate([np.array(r, dtype=float) for r in raydirs])
+    culled = 0
+    if cull_escapes:
+        margin = 0 if engine == "exact" else step_size
+        keep = ~tracer.escape_cone_culled(pos, dirs, stage["compiled"], crit_angle=CRIT_ANGLE, margin=margin)
+        culled = len(pos) - np.count_nonzero(keep)
+        pos, dirs = pos[keep], dirs[keep]
+    return pos, dirs, culled
+
+
+def batch_results(stage, res, culled=0, engine="batch", weighted=False):
+    """
+    Count the rays of a tracer result and return the detected ones, as
+    run_trial keeps them: (endpoints, opls, enddirs), and their weights if
+    weighted.
+    """
+    if engine in ("exact", "unfolded"):
+        good = res["detected"]
+        steps = 0
+    else:
+        good = res["detected"] & (res["pathlen"] > 3)
+        steps = res["pathlen"].sum()
+    weights = res["weight"][good] if weighted else None
+    count_status(stage, res["status"], culled, steps, None if weights is None else weights.sum())
+    results = list(res["end"][good]), list(res["opl"][good]), list(res["enddir"][good])
+    return results + (list(weights),) if weighted else results
+
+
+def fresnel_indices(weighted):
+    """The fresnel argument of the tracers: the refractive indices for weighted rays, else None."""
+    return (N1, N2) if weighted else None
+
+
+def run_batch(stage, tiles, raydirs, step_size=0.1, max_steps=10000, engine="batch", cull_escapes=True, stats=None, weighted=False):
+    """
+    Trace every direction in raydirs from every point in tiles, with
+    tracer.march_rays ("batch") or the event driven tracer.trace_rays
+    ("exact"). The exact tracer has no step, so step_size only sets its
+    OPL cut off of max_steps * step_size. Rays that can only escape through
+    the z walls are dropped before tracing and counted as escaped, unless
+    weighted, as weighted rays never simply escape.
+    """
+    pos, dirs, culled = launch_rays(stage, tiles, raydirs, step_size, engine, cull_escapes and not weighted)
+    if engine == "exact":
+        res = tracer.trace_rays(pos, dirs, stage["compiled"], max_opl=max_steps*step_size, crit_angle=CRIT_ANGLE, stats=stats,
+                                fresnel=fresnel_indices(weighted))
+    else:
+        res = tracer.march_rays(pos, dirs, stage["compiled"], dl=step_size, max_steps=max_steps, crit_angle=CRIT_ANGLE, stats=stats,
+                                fresnel=fresnel_indices(weighted))
+    return batch_results(stage, res, culled, engine, weighted)
+
+
+def run_wavefront(stage, tiles, done, emit, step_size=0.1, max_steps=10000, batch_tiles=1, cull_escapes=True, use_progbar=True, stats=None, stop=None,
+                  weighted=False):
+    """
+    The batch engine of run_trial: the tile chunks not in done are marched
+    through one tracer.march_stream wavefront, and each is passed to emit
+    as soon as all its rays have finished, so chunks can be emitted out of
+    order. Stops early once stop() is true, if given.
+    """
+    culled = {}
+
+    def launches():
+        for j in progress(range(0, len(tiles), batch_tiles), use_progbar):
+            if j in done:
+                continue
+            chunk = tiles[j:j+batch_tiles]
+            log_tile(stage, j+len(chunk), len(tiles))
+            with instrument.timer(stats, "sample"):
+                raydirs = tile_raydirs(stage, j, len(chunk))
+            pos, dirs, culled[j] = launch_rays(stage, chunk, raydirs, step_size, "batch", cull_escapes and not weighted)
+            yield j, pos, dirs
+
+    # sampling is timed inside the stream, the rest of its time is tracing
+    lap, sampling_time = time.perf_counter(), stats["time_sample"]
+    for j, res in tracer.march_stream(launches(), stage["compiled"], dl=step_size, max_steps=max_steps, crit_angle=CRIT_ANGLE, stats=stats,
+                                      fresnel=fresnel_indices(weighted)):
+        stats["time_trace"] += time.perf_counter() - lap - (stats["time_sample"] - sampling_time)
+        emit(j, *batch_results(stage, res, culled.pop(j), weighted=weighted))
+        lap, sampling_time = time.perf_counter(), stats["time_sample"]
+        if stop is not None and stop():
+            break
+
+
+def sweep_stage(stage, zwalls):
+    """Copy of stage between the z walls zwalls, with the raypoints rescaled into the new z range."""
+    new = dict(stage, zwalls=zwalls, zrange=[zwalls[0], zwalls[1]])
+    c = stage["compiled"]
+    new["compiled"] = tracer.build_stage(c["name"], c["start"], c["end"], c["type"], zwalls, c["bulge"])
+    if "raypoints" in stage:
+        frac = (np.array(stage["raypoints"])[:, 2] - stage["zwalls"][0]) / (stage["zwalls"][1] - stage["zwalls"][0])
+        new["raypoints"] = [[x, y, zwalls[0] + f * (zwalls[1] - zwalls[0])] for (x, y, _), f in zip(stage["raypoints"], frac)]
+    return new
+
+
+def run_sweep(stage, zwalls_list, step_size=0.1, max_steps=10000, use_progbar=True, batch_tiles=1, writers=None, hists=None, keep_rays=True, tolerance=None,
+              weighted=False):
+    """
+    Trace the in-plane motion of every ray once (tracer.trace_rays with
+    unfold_z) and fold it into each pair of z walls in zwalls_list. Returns
+    a stage per thickness (see sweep_stage, with its own counts) and the
+    matching (endpoints, opls, enddirs). writers, if given, is a function
+    taking a thickness' stage and returning its store.ResultWriter; results
+    then go to disk tile chunk by tile chunk and the returned lists are empty.
+    Chunks a (reopened) writer already has are skipped. hists works the same
+    way for histograms.Histograms, and keep_rays=False keeps only those.
+    With a tolerance (see sampling.Convergence) each thickness stops taking
+    tiles once it has converged, and the trace stops when all have. weighted
+    is as for run_trial, and adds the weights to each thickness' results.
+    """
+    tiles = stage["raypoints"]
+    stages = [sweep_stage(stage, zw) for zw in zwalls_list]
+    results = [([], [], [], []) if weighted else ([], [], []) for _ in stages]
+    outs = [writers(st) for st in stages] if writers is not None else [None for _ in stages]
+    accs = [hists(st) for st in stages] if hists is not None else [None for _ in stages]
+    convs = [sampling.stage_convergence(st, tolerance) for st in stages]
+    stopped = [False for _ in stages]
+    for st, out in zip(stages, outs):
+        st["counts"] = new_counts(out)
+        st["stats"] = new_stats(st, out)
+
+    for j in progress(range(0, len(tiles), batch_tiles), use_progbar):
+        if all(stopped):
+            break
+        if all(stop or (out is not None and j in out.done) for stop, out in zip(stopped, outs)):
+            continue
+        chunk = tiles[j:j+batch_tiles]
+        log_tile(stage, j+len(chunk), len(tiles))
+        # the shared in-plane trace is counted (and timed) in full for every thickness, side wall
+        # reflections included, though it carries on past where a ray escapes through a z wall
+        shared = instrument.new_stats(len(stage["compiled"]["start"]))
+        with instrument.timer(shared, "sample"):
+            raydirs = tile_raydirs(stage, j, len(chunk))
+        counts = [len(r) for r in raydirs]
+        dirs = raydirs.reshape(-1, 3)
+        pos = np.repeat(np.array(chunk, dtype=float), counts, axis=0)
+        with instrument.timer(shared, "trace"):
+            res = tracer.trace_rays(pos, dirs, stage["compiled"], max_opl=max_steps*step_size, crit_angle=CRIT_ANGLE, unfold_z=True, stats=shared,
+                                    fresnel=fresnel_indices(weighted))
+        for k, (st, result, out, acc, conv) in enumerate(zip(stages, results, outs, accs, convs)):
+            if stopped[k] or (out is not None and j in out.done):
+                continue
+            instrument.merge(st["stats"], shared)
+            with instrument.timer(st["stats"], "trace"):
+                pos = np.repeat(np.array(st["raypoints"][j:j+batch_tiles], dtype=float), counts, axis=0)
+                folded = tracer.fold_z(pos, dirs, res, st["zwalls"], crit_angle=CRIT_ANGLE, stats=st["stats"], fresnel=fresnel_indices(weighted))
+            ends, ls, ds, *ws = batch_results(st, folded, engine="unfolded", weighted=weighted)
+            if conv is not None:
+                conv.add(ends, ls, len(pos), *ws)
+                stopped[k] = conv.done()
+            with instrument.timer(st["stats"], "save"):
+                if acc is not None:
+                    acc.add(ends, ls, ds, *ws)
+                if out is not None:
+                    if not keep_rays:
+                        ends, ls, ds, ws = [], [], [], [[] for w in ws]
+                    out.append(ends, ls, ds, *ws, chunk=j, counts=st["counts"], hists=acc, stats=st["stats"])
+                elif keep_rays:
+                    for col, new in zip(result, [ends, ls, ds] + ws):
+                        col += new
+        # every thickness counts the rays of the one shared trace
+        chunk_done(max(st["counts"]["rays"] for st in stages))
+    for st, out, acc, conv in zip(stages, outs, accs, convs):
+        if conv is not None:
+            st["convergence"] = conv.report()
+        if out is not None:
+            out.close(st["counts"], acc, convergence=st.get("convergence"), stats=st["stats"])
+    return stages, results
+
+
+def run_trial(stage, show_single_trace=False, step_size=0.1, max_steps=10000,use_progbar=True, engine="scalar", batch_tiles=1, cull_escapes=True, writer=None, hists=None, keep_rays=True, tolerance=None,
+              weighted=False):
+    """
+    Trace every raypoint of the stage with the chosen engine. If a
+    store.ResultWriter is given the results are appended to it as each tile
+    (or chunk of batch_tiles tiles) finishes, and not kept in memory: the
+    returned lists are then empty. Tiles the writer already has (see
+    store.ResultWriter.reopen) are skipped. A histograms.Histograms given as
+    hists is filled as the tiles finish; with keep_rays=False it is all that
+    is kept. With a tolerance (see sampling.Convergence) the raypoints are a
+    budget: tracing stops at the first tile chunk after which the targets
+    are met, and the report is left in stage["convergence"]. The batch
+    engine marches every chunk through one wavefront (see run_wavefront),
+    so its chunks finish, and are saved, out of order.
+
+    With weighted, rays are not lost at the mirror and z walls: each carries
+    a weight, scaled by the Fresnel reflectance (from N1 into N2) at every
+    wall it meets, with Russian roulette once it is light (see
+    tracer.fresnel_survivors). The detected rays' weights are returned as a
+    fourth list, and the histograms, convergence check, saved results and
+    counts["detected_weight"] are all weighted. Only the vector engines
+    trace weighted rays, and escape culling is off for them.
+
+    The two modes do not model the same walls. Unweighted rays keep the
+    original test (is_outside_crit_angle), which compares the angle between
+    the ray and the wall with CRIT_ANGLE, so they escape within 90 degrees
+    less CRIT_ANGLE of the normal (about 48). Weighted rays are totally
+    reflected past CRIT_ANGLE itself (about 42), as in the real slab, so
+    they keep much more light in: a weighted run's efficiency is not an
+    estimate of the unweighted one (about 0.40 against 0.16 on the
+    rectangle, see tests/test_tracer.py).
+    """
 
     tiles = stage["raypoints"]
+    stage["counts"] = new_counts(writer)
+    stage["stats"] = stats = new_stats(stage, writer)
+    done = writer.done if writer is not None else set()
+    conv = sampling.stage_convergence(stage, tolerance)
+    traced = [stage["counts"]["rays"]]
 
     endpoints, opls, enddirs = [], [], []
-    if use_progbar:
-        loopiter = progressbar.progressbar(range(len(tiles)), redirect_stdout=False)
-    else:
-        loopiter = range(len(tiles))
-    for j in loopiter:
+    results = (endpoints, opls, enddirs, []) if weighted else (endpoints, opls, enddirs)
+
+    def emit(chunk, *result):
+        # result is (ends, opls, dirs) and, for weighted rays, weights
+        chunk_done(stage["counts"]["rays"])
+        if conv is not None:
+            conv.add(result[0], result[1], stage["counts"]["rays"] - traced[0], *result[3:])
+            traced[0] = stage["counts"]["rays"]
+        with instrument.timer(stats, "save"):
+            if hists is not None:
+                hists.add(*result)
+            if writer is not None:
+                if not keep_rays:
+                    result = [[] for _ in result]
+                writer.append(*result, chunk=chunk, counts=stage["counts"], hists=hists, stats=stats)
+            elif keep_rays:
+                for col, new in zip(results, result):
+                    col.extend(new)
+
+    if stage["compiled"]["arcs"] is not None and (engine == "scalar" or show_single_trace):
+        # the scalar tracer works on the shapely edges, which only have the chords of arcs
+        raise ValueError("The scalar engine cannot trace the arc edges of " + stage["name"])
+    if weighted and (engine == "scalar" or show_single_trace):
+        raise ValueError("The scalar engine cannot trace weighted rays")
+
+    if engine == "unfolded" and not show_single_trace:
+        writers = None if writer is None else (lambda st: writer)
+        accs = None if hists is None else (lambda st: hists)
+        stages, sweep = run_sweep(stage, [stage["zwalls"]], step_size=step_size, max_steps=max_steps, use_progbar=use_progbar, batch_tiles=batch_tiles,
+                                  writers=writers, hists=accs, keep_rays=keep_rays, tolerance=tolerance, weighted=weighted)
+        stage["counts"] = stages[0]["counts"]
+        stage["stats"] = stages[0]["stats"]
+        if conv is not None:
+            stage["convergence"] = stages[0]["convergence"]
+        return sweep[0]
+    elif engine == "batch" and not show_single_trace:
+        run_wavefront(stage, tiles, done, emit, step_size=step_size, max_steps=max_steps, batch_tiles=batch_tiles, cull_escapes=cull_escapes,
+                      use_progbar=use_progbar, stats=stats, stop=None if conv is None else conv.done, weighted=weighted)
+        if conv is not None:
+            stage["convergence"] = conv.report()
+        return results
+    elif engine == "exact" and not show_single_trace:
+        for j in progress(range(0, len(tiles), batch_tiles), use_progbar):
+            if j in done:
+                continue
+            chunk = tiles[j:j+batch_tiles]
+            log_tile(stage, j+len(chunk), len(tiles))
+            with instrument.timer(stats, "sample"):
+                raydirs = tile_raydirs(stage, j, len(chunk))
+            with instrument.timer(stats, "trace"):
+                result = run_batch(stage, chunk, raydirs, step_size=step_size, max_steps=max_steps, engine=engine, cull_escapes=cull_escapes, stats=stats,
+                                   weighted=weighted)
+            emit(j, *result)
+            if conv is not None and conv.done():
+                break
+        if conv is not None:
+            stage["convergence"] = conv.report()
+        return results
+    elif engine not in ("scalar", "batch", "exact", "unfolded"):
+        raise ValueError("Unknown engine " + str(engine))
+
+    if show_single_trace:
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D
+    for j in progress(range(len(tiles)), use_progbar):
+        if j in done:
+            continue
         tile = tiles[j]
-        print(stage["name"] + ": TILE", j+1, "/", len(tiles))
-        raydirs = random_fibonacci_sphere(stage["numradials"])
+        log_tile(stage, j+1, len(tiles))
+        with instrument.timer(stats, "sample"):
+            raydirs = tile_raydirs(stage, j)[0]
+        tile_ends, tile_opls, tile_dirs = [], [], []
+        trace_start = time.perf_counter()
         for i, raydir in enumerate(raydirs):
             raydir_norm = normalise(np.array(raydir))
             rayObj = (raydir_norm, np.array(tile))
-            path, opl = sim_ray(rayObj, stage, dl=step_size, max_steps=max_steps)
+            if show_single_trace:
+                path, opl = sim_ray(rayObj, stage, dl=step_size, max_steps=max_steps)
+            elif cull_escapes and tracer.escape_cone_culled(rayObj[1][None], rayObj[0][None], stage["compiled"], crit_angle=CRIT_ANGLE, margin=step_size)[0]:
+                path = None
+                count_status(stage, [], culled=1)
+            else:
+                path = None
+                state = trace_ray(rayObj, stage, dl=step_size, max_steps=max_steps, stats=stats)
+                count_status(stage, state["status"], steps=state["pathlen"])
+                if state["status"] == tracer.DETECTED and state["pathlen"] > 3:
+                    tile_ends.append(state["end"])
+                    tile_dirs.append(state["enddir"])
+                    tile_opls.append(state["opl"])
+
             if path is not None and len(path) > 3:
                 last_point = path[-1]
                 last_point2 = path[-3]
@@ -218,6 +669,10 @@ def run_trial(stage, show_single_trace=False, step_size=0.1, max_steps=10000,use
                 break
         if show_single_trace:
             break
+        stats["time_trace"] += time.perf_counter() - trace_start
+        emit(j, tile_ends, tile_opls, tile_dirs)
+        if conv is not None and conv.done():
+            break
 
     if show_single_trace:
         ax.scatter([t[0] for t in tiles], [t[1] for t in tiles], [t[2] for t in tiles])
@@ -230,16 +685,95 @@ def run_trial(stage, show_single_trace=False, step_size=0.1, max_steps=10000,use
         plt.show()
         exit()
 
+    if conv is not None:
+        stage["convergence"] = conv.report()
     return endpoints, opls, enddirs
 
 
-def save_data(endpoints, opls, enddirs, stage):
-    datadict = {"ends":endpoints, "opls":opls, "dir":enddirs, "stage":stage}
-    with open("./data/data-" + stage["name"] + "-{date:%Y-%m-%d_%H:%M:%S}.pickle".format(date=datetime.datetime.now()), "wb") as f:
-        pickle.dump(datadict, f)
+def save_data(endpoints, opls, enddirs, stage, params=None, hists=None):
+    """Write a whole set of results at once, in the store format. Returns the run directory."""
+    writer = store.ResultWriter(store.run_path(stage["name"]), stage, params)
+    writer.append(endpoints, opls, enddirs)
+    writer.close(stage.get("counts"), hists)
+    return writer.path
+
+
+def trial_to_store(stage, step_size=0.1, max_steps=10000, engine="scalar", batch_tiles=1, cull_escapes=True, keep_rays=True, histogram=True, use_progbar=True, tolerance=None,
+                   weighted=False):
+    """
+    run_trial straight into a new store run, committed tile chunk by tile
+    chunk so that a killed run can be carried on with resume_trial. Returns
+    the run directory.
+    """
+    trial = dict(step_size=step_size, max_steps=max_steps, engine=engine, batch_tiles=batch_tiles, cull_escapes=cull_escapes, keep_rays=keep_rays, tolerance=tolerance,
+                 weighted=weighted)
+    params = dict(trial, num_raypoints=len(stage["raypoints"]), num_radials=stage["numradials"], histogram=histogram)
+    writer = store.ResultWriter(store.run_path(stage["name"]), stage, params)
+    hists = histograms.stage_histograms(stage, max_steps*step_size) if histogram else None
+    run_trial(stage, use_progbar=use_progbar, writer=writer, hists=hists, **trial)
+    writer.close(stage["counts"], hists, convergence=stage.get("convergence"), stats=stage["stats"])
+    print(stage["name"] + ":", instrument.summary(stage["stats"], stage["counts"]))
+    return writer.path
+
+
+def resume_trial(path, use_progbar=True):
+    """
+    Carry on an unfinished trial_to_store run, skipping the tiles it already
+    has. Tiles get the same rays they would have had in the first run, so
+    the finished run is the same as an uninterrupted one.
+    """
+    writer = store.ResultWriter.reopen(path)
+    meta, params = writer.meta, writer.meta["params"]
+    stage = get_stage(shape=meta["name"], zwalls=tuple(meta["zwalls"]))
+    if stage["compiled"]["hash"] != meta["hash"]:
+        raise ValueError("Geometry of " + meta["name"] + " has changed since " + path + " was started")
+    stage["raypoints"] = np.load(os.path.join(path, "raypoints.npy")).tolist()
+    stage["numradials"] = meta["numradials"]
+    stage["seed"] = meta["seed"]
+    if meta.get("sampling"):
+        stage["sampling"] = meta["sampling"]
+    hists = writer.hists
+    if hists is None and params["histogram"]:
+        hists = histograms.stage_histograms(stage, params["max_steps"] * params["step_size"])
+    trial = {k:params[k] for k in ("step_size", "max_steps", "engine", "batch_tiles", "cull_escapes", "keep_rays")}
+    trial["weighted"] = params.get("weighted", False)
+    # the batches traced before the restart are not in the new convergence check
+    run_trial(stage, use_progbar=use_progbar, writer=writer, hists=hists, tolerance=params.get("tolerance"), **trial)
+    writer.close(stage["counts"], hists, convergence=stage.get("convergence"), stats=stage["stats"])
+    print(stage["name"] + ":", instrument.summary(stage["stats"], stage["counts"]))
+    return path
+
+
+def compare_sampling(shape="rectangle", modes=(("random", "fibonacci"), ("sobol", "sobol")), replicates=8, num_raypoints=100, num_radials=64,
+                     zwalls=(0,0.1), step_size=0.01, max_steps=10000, engine="exact", seed=0):
+    """
+    Run the same trial replicates times (seeds seed, seed+1, ...) for each
+    (points, dirs) sampling mode and print the spread of the collection
+    efficiency and mean OPL. The cost column is the variance of the
+    efficiency times the rays traced per replicate, relative to the first
+    mode: how many times more rays that mode needs for the same error.
+    """
+    table = []
+    for points, dirs in modes:
+        effs, mean_opls, rays = [], [], 0
+        for r in range(replicates):
+            stage = get_stage(shape=shape, zwalls=zwalls)
+            add_raypoints(stage, num_raypoints=num_raypoints, num_radials=num_radials, seed=seed + r, points=points, dirs=dirs)
+            endpoints, opls, enddirs = run_trial(stage, step_size=step_size, max_steps=max_steps, use_progbar=False, engine=engine)
+            effs.append(len(opls) / stage["counts"]["rays"])
+            mean_opls.append(np.mean(opls) if len(opls) else np.nan)
+            rays += stage["counts"]["rays"]
+        table.append({"points":points, "dirs":dirs, "rays":rays // replicates,
+                      "efficiency":np.mean(effs), "efficiency_err":np.std(effs, ddof=1),
+                      "mean_opl":np.nanmean(mean_opls), "mean_opl_err":np.nanstd(mean_opls, ddof=1)})
+    for row in table:
+        row["cost"] = row["efficiency_err"] ** 2 * row["rays"] / (table[0]["efficiency_err"] ** 2 * table[0]["rays"])
+        print("{points:>10} {dirs:>10}: efficiency {efficiency:.5f} +- {efficiency_err:.5f}, mean OPL {mean_opl:.4f} +- {mean_opl_err:.4f}, cost {cost:.2f}".format(**row))
+    return table
 
 
 def main():
+    import lux
     f = lux.Flag()
     f.busy()
     #shapes = ["rectangle", "semicircle", "triangle1","angled"]
@@ -253,12 +787,30 @@ def main():
     f.ready()
 
 
-def external_run(shape="", num_raypoints=1000, num_radials=200, max_steps=10000, zwalls=(0,0.1), step_size=0.01):
+def external_run(shape="", num_raypoints=1000, num_radials=200, max_steps=10000, zwalls=(0,0.1), step_size=0.01, engine="scalar", cull_escapes=True, workers=None, histogram=True, keep_rays=True, seed=None, points="random", dirs="fibonacci", tolerance=None, weighted=False):
+    """
+    Trace and save one shape on the parallel_fluorotrace3 worker pool. With
+    a tolerance (see sampling.Convergence) num_raypoints is only a budget.
+    """
+    import parallel_fluorotrace3
     if shape != "":
-        stage = get_stage(shape=shape,zwalls=zwalls)
-        add_raypoints(stage, num_raypoints=num_raypoints, num_radials=num_radials)
-        endpoints, opls, enddirs = run_trial(stage, show_single_trace=False, step_size = step_size, max_steps=max_steps,use_progbar=False)
-        save_data(endpoints, opls, enddirs, stage)
+        parallel_fluorotrace3.run_shapes([shape], num_raypoints=num_raypoints, num_radials=num_radials,
+                                         max_steps=max_steps, zwalls=zwalls, step_size=step_size, engine=engine,
+                                         cull_escapes=cull_escapes, workers=workers or parallel_fluorotrace3.NUM_WORKERS,
+                                         histogram=histogram, keep_rays=keep_rays, seed=seed, points=points, dirs=dirs, tolerance=tolerance, weighted=weighted)
+
+
+def external_sweep(shape="", zwalls_list=((0,0.1),), num_raypoints=1000, num_radials=200, max_steps=10000, step_size=0.01, histogram=True, keep_rays=True, seed=None, points="random", dirs="fibonacci", tolerance=None, weighted=False):
+    """external_run for a list of thicknesses, traced once with the unfolded tracer."""
+    if shape != "":
+        stage = get_stage(shape=shape,zwalls=zwalls_list[0])
+        add_raypoints(stage, num_raypoints=num_raypoints, num_radials=num_radials, seed=seed, points=points, dirs=dirs)
+        params = dict(num_raypoints=num_raypoints, num_radials=num_radials, max_steps=max_steps, step_size=step_size, engine="unfolded", tolerance=tolerance,
+                      weighted=weighted)
+        run_sweep(stage, zwalls_list, step_size=step_size, max_steps=max_steps, use_progbar=False, weighted=weighted,
+                  writers=lambda st: store.ResultWriter(store.run_path(st["name"]), st, params),
+                  hists=lambda st: histograms.stage_histograms(st, max_steps*step_size) if histogram else None,
+                  keep_rays=keep_rays, tolerance=tolerance)
 
 
 if __name__ == "__main__":
@@ -3,7 +3,19 @@
 import numpy as np
 
 
+class UnknownShape(ValueError):
+    pass
+
+
 def get_shape(shape=""):
+    """
+    Outline nodes of a shape, the type of each edge (from node i to node i+1,
+    wrapping round) and its bulge: 0 for a straight edge, or tan(angle / 4)
+    for a circular arc turning through angle, positive when it runs
+    counterclockwise round its centre (so a straight edge bulged by 1 becomes
+    the semicircle on its right). Raises UnknownShape for any other name.
+    """
+    bulges = None
     if shape == "rectangle":
         nodes   = [[0,0], [0,1], [2,1], [2,0]]
         edge_types = [ "m",  "m",  "d",  "m"]
@@ -15,6 +27,11 @@ def get_shape(shape=""):
         edge_types = ["m" for x in nodes]
         edge_types[-1] = "d"
         edge_types.append("m")
+    elif shape == "semicircle_arc":
+        # semicircle as one exact arc, rather than 19 facets
+        nodes = [[0,1], [0,-1]]
+        edge_types = ["m", "d"]
+        bulges = [1, 0]
     elif shape == "triangle1":
         nodes = [[1,0], [0,1], [1,2]]
         edge_types = ["m", "m", "d"]
@@ -22,7 +39,8 @@ def get_shape(shape=""):
         nodes = [[1,0], [0,1], [1,2]]
         edge_types = ["m", "m", "d"]
     else:
-        print("Shape", shape, "is not defined! Exiting Thread...")
-        exit()
+        raise UnknownShape("Shape " + str(shape) + " is not defined")
 
-    return nodes, edge_types
+    if bulges is None:
+        bulges = [0 for n in nodes]
+    return nodes, edge_types, bulges
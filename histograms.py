@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+import tracer
+
+
+def exit_angles(enddirs):
+    """Exit angle (degrees) in the yz plane against the x wall normal, as plotted by analyse."""
+    d = np.asarray(enddirs, dtype=float).reshape(-1, 3)
+    angle = np.arccos(np.clip(d[:, 0] / np.linalg.norm(d, axis=1), -1, 1))
+    angle = -np.pi/2 + np.abs(angle)
+    angle = (angle + np.pi) % (2 * np.pi) - np.pi
+    return 180 * angle / np.pi
+
+
+def scatter_angles(enddirs):
+    """Unsigned exit angle (degrees) used by the exit angle vs OPL plot."""
+    angle = np.abs(exit_angles(enddirs))
+    return np.where(angle == 90, 0, angle)
+
+
+def binned_counts(x, y, xedges, yedges, weights=None):
+    """
+    2D histogram of the points (x, y) (with weights, if given) over evenly
+    spaced edges, the same as np.histogram2d but by direct bin arithmetic,
+    which is several times faster. Points outside the edges are left out.
+    """
+    nx, ny = len(xedges) - 1, len(yedges) - 1
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    ix = np.floor((x - xedges[0]) / (xedges[-1] - xedges[0]) * nx).astype(np.int64)
+    iy = np.floor((y - yedges[0]) / (yedges[-1] - yedges[0]) * ny).astype(np.int64)
+    # the last edge is inclusive, as in np.histogram2d
+    ix[x == xedges[-1]] = nx - 1
+    iy[y == yedges[-1]] = ny - 1
+    ok = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    w = None if weights is None else np.asarray(weights, dtype=float)[ok]
+    return np.bincount(ix[ok] * ny + iy[ok], weights=w, minlength=nx * ny).reshape(nx, ny)
+
+
+def joint_counts(enddirs, opls, angle_edges, opl_edges, chunk=1000000, weights=None):
+    """
+    Exit angle / OPL counts of the rays (summed weights, if given), as
+    Histograms keeps them, a chunk of rays at a time so memory mapped
+    columns of any length fit in memory.
+    """
+    counts = np.zeros((len(angle_edges) - 1, len(opl_edges) - 1), dtype=np.int64 if weights is None else float)
+    for i in range(0, len(opls), chunk):
+        w = None if weights is None else weights[i:i + chunk]
+        counts += binned_counts(scatter_angles(enddirs[i:i + chunk]), opls[i:i + chunk], angle_edges, opl_edges, w)
+    return counts
+
+
+def smoothed_density(counts, xedges, yedges, bandwidth=None):
+    """
+    Gaussian kernel density estimate on the grid of binned counts, by FFT
+    convolution with the kernel, normalised to integrate to 1. bandwidth
+    scales the kernel widths, which are Scott's rule (as gaussian_kde uses)
+    applied to each axis, in data units; it is never narrower than a bin.
+    """
+    # scipy.signal is slow to import, and only the plots need it
+    from scipy.signal import fftconvolve
+    counts = np.asarray(counts, dtype=float)
+    n = counts.sum()
+    if not n:
+        return np.zeros_like(counts)
+    xs = 0.5 * (xedges[1:] + xedges[:-1])
+    ys = 0.5 * (yedges[1:] + yedges[:-1])
+    px, py = counts.sum(axis=1) / n, counts.sum(axis=0) / n
+    std = np.array([np.sqrt(np.sum(px * (xs - np.sum(px * xs)) ** 2)), np.sqrt(np.sum(py * (ys - np.sum(py * ys)) ** 2))])
+    width = np.array([xedges[1] - xedges[0], yedges[1] - yedges[0]])
+    sigma = np.maximum((bandwidth or n ** (-1 / 6)) * std / width, 1)
+    # kernel out to 4 sigma, in bins
+    kx, ky = [np.arange(-int(4 * s), int(4 * s) + 1) for s in sigma]
+    kernel = np.outer(np.exp(-0.5 * (kx / sigma[0]) ** 2), np.exp(-0.5 * (ky / sigma[1]) ** 2))
+    density = fftconvolve(counts, kernel / kernel.sum(), mode="same")
+    return np.maximum(density, 0) / (n * width[0] * width[1])
+
+
+class Histograms:
+    """
+    Fixed-bin accumulators for detector position, OPL, exit angle and the
+    joint exit angle / OPL distribution, plus the OPL sum, min and max.
+    They are filled a batch of rays at a time and merge exactly (same bins)
+    across tiles, workers and shards, so a run can keep these instead of
+    every ray. Weighted rays (see fluorotrace3.run_trial) add their weights,
+    and the counts, n and OPL sum are then floats.
+    """
+    def __init__(self, yrange=(0, 1), max_opl=100.0, pos_bins=300, opl_bins=10000, angle_bins=300, joint_bins=(180, 2000)):
+        self.edges = {"pos":np.linspace(yrange[0], yrange[1], pos_bins + 1),
+                      "opl":np.linspace(0, max_opl, opl_bins + 1),
+                      "angle":np.linspace(-90, 90, angle_bins + 1),
+                      "joint_angle":np.linspace(0, 90, joint_bins[0] + 1),
+                      "joint_opl":np.linspace(0, max_opl, joint_bins[1] + 1)}
+        self.counts = {"pos":np.zeros(pos_bins, dtype=np.int64),
+                       "opl":np.zeros(opl_bins, dtype=np.int64),
+                       "angle":np.zeros(angle_bins, dtype=np.int64),
+                       "joint":np.zeros(joint_bins, dtype=np.int64)}
+        self.n, self.opl_sum, self.opl_min, self.opl_max = 0, 0.0, np.inf, -np.inf
+
+    def add(self, endpoints, opls, enddirs, weights=None):
+        opls = np.asarray(opls, dtype=float).ravel()
+        if not len(opls):
+            return
+        ends = np.asarray(endpoints, dtype=float).reshape(-1, 3)
+        angles = exit_angles(enddirs)
+        w = None if weights is None else np.asarray(weights, dtype=float).ravel()
+        add = {"pos":np.histogram(ends[:, 1], self.edges["pos"], weights=w)[0],
+               "opl":np.histogram(opls, self.edges["opl"], weights=w)[0],
+               # analyse plots each exit angle and its mirror image
+               "angle":np.histogram(np.concatenate([angles, -angles]), self.edges["angle"], weights=None if w is None else np.tile(w, 2))[0],
+               "joint":np.histogram2d(scatter_angles(enddirs), opls, [self.edges["joint_angle"], self.edges["joint_opl"]], weights=w)[0]}
+        for k, v in add.items():
+            # integer counts until the first weights come
+            self.counts[k] = self.counts[k] + (v.astype(np.int64) if w is None and self.counts[k].dtype.kind == "i" else v)
+        if w is None:
+            self.n += len(opls)
+            self.opl_sum += float(opls.sum())
+        else:
+            self.n += float(w.sum())
+            self.opl_sum += float(np.dot(w, opls))
+        self.opl_min = min(self.opl_min, float(opls.min()))
+        self.opl_max = max(self.opl_max, float(opls.max()))
+
+    def merge(self, other):
+        for k in self.edges:
+            if not np.array_equal(self.edges[k], other.edges[k]):
+                raise ValueError("Cannot merge histograms with different " + k + " bins")
+        for k in self.counts:
+            self.counts[k] = self.counts[k] + other.counts[k]
+        self.n += other.n
+        self.opl_sum += other.opl_sum
+        self.opl_min = min(self.opl_min, other.opl_min)
+        self.opl_max = max(self.opl_max, other.opl_max)
+        return self
+
+    def mean_opl(self):
+        return self.opl_sum / self.n if self.n else np.nan
+
+    def to_arrays(self):
+        arrs = {"edges_" + k:v for k, v in self.edges.items()}
+        arrs.update({"counts_" + k:v for k, v in self.counts.items()})
+        arrs["summary"] = np.array([self.n, self.opl_sum, self.opl_min, self.opl_max])
+        return arrs
+
+    @classmethod
+    def from_arrays(cls, arrs):
+        hists = cls.__new__(cls)
+        hists.edges = {k[6:]:np.asarray(v) for k, v in arrs.items() if k.startswith("edges_")}
+        hists.counts = {k[7:]:np.array(v) for k, v in arrs.items() if k.startswith("counts_")}
+        n, hists.opl_sum, hists.opl_min, hists.opl_max = arrs["summary"]
+        hists.n = int(n) if hists.counts["pos"].dtype.kind == "i" else float(n)
+        return hists
+
+
+def stage_histograms(stage, max_opl, **bins):
+    """Histograms with the position bins over the stage's y range."""
+    c = stage["compiled"]
+    lo, hi = tracer.stage_bounds(c)
+    return Histograms(yrange=(lo[1], hi[1]), max_opl=max_opl, **bins)
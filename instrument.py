@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+import time
+import contextlib
+
+import numpy as np
+
+# phases timed by run_trial, per tile chunk
+PHASES = ["sample", "trace", "save"]
+
+
+def new_stats(n_edges=0):
+    """
+    Zeroed hot path counters and phase timers for a stage with n_edges side
+    walls: point in polygon tests, ray / edge intersection tests, exact
+    tracer events, reflections off the z walls and off each side wall, rays
+    stopped for bouncing without moving (stuck) and seconds per phase.
+    """
+    stats = {"contains":0, "edge_tests":0, "events":0, "reflect_z":0, "reflect_edge":[0] * n_edges, "stuck":0}
+    stats.update({"time_" + phase:0.0 for phase in PHASES})
+    return stats
+
+
+def add(stats, reflect_edge=None, **counters):
+    """Add counters (and an array of reflections per side wall) to stats, if stats is not None."""
+    if stats is None:
+        return
+    for k, v in counters.items():
+        if isinstance(v, np.generic):
+            v = v.item()
+        stats[k] = stats.get(k, 0) + v
+    if reflect_edge is not None:
+        old = stats.get("reflect_edge") or [0] * len(reflect_edge)
+        stats["reflect_edge"] = [int(a + b) for a, b in zip(old, reflect_edge)]
+
+
+def merge(total, part):
+    """Add the stats part (from another tile chunk or worker) into total and return it."""
+    if total is None:
+        return {k:list(v) if isinstance(v, list) else v for k, v in part.items()}
+    reflect_edge = part.get("reflect_edge")
+    add(total, reflect_edge=reflect_edge or None, **{k:v for k, v in part.items() if k != "reflect_edge"})
+    return total
+
+
+@contextlib.contextmanager
+def timer(stats, phase):
+    """Add the time spent in the with block to stats["time_" + phase]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats["time_" + phase] = stats.get("time_" + phase, 0.0) + time.perf_counter() - start
+
+
+def chunk_times(stats, before):
+    """
+    Sampling and tracing seconds spent since the stats before were taken.
+    Saving is left out, as a chunk is committed before its save is timed.
+    """
+    before = before or {}
+    return [stats.get("time_" + phase, 0.0) - before.get("time_" + phase, 0.0) for phase in ("sample", "trace")]
+
+
+def summary(stats, counts):
+    """One line of the counters that matter when a run looks slow or loses rays."""
+    rays = max(counts.get("rays", 0), 1)
+    lost = {k:counts.get(k, 0) for k in ("max_steps", "escaped_z", "escaped_side", "dumped", "no_intersection", "culled") if counts.get(k)}
+    times = ", ".join("{} {:.2f}s".format(p, stats.get("time_" + p, 0.0)) for p in PHASES)
+    return "{} rays: {:.1f} steps/ray, {:.1f} edge tests/ray, {:.2f} reflections/ray, stuck {}, lost {}; {}".format(
+        counts.get("rays", 0), counts.get("steps", 0) / rays, stats.get("edge_tests", 0) / rays,
+        (stats.get("reflect_z", 0) + sum(stats.get("reflect_edge", []))) / rays, stats.get("stuck", 0), lost, times)
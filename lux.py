@@ -4,15 +4,16 @@ try:
     #Create the file: /etc/udev/rules.d/10-luxafor.rules with the following contents:
     #ACTION=="add", SUBSYSTEM=="usb", ATTRS{idProduct}=="f372", ATTRS{idVendor}=="04d8", MODE:="666"
 except Exception:
+    # the flag is only a status light, runs go on without it
     print("Pyluxafor not installed... run pip3 install pyluxafor")
-    exit()
+    LuxaforFlag = None
 import time
 
 
 class Flag:
     def __init__(self):
         try:
-            flag = LuxaforFlag()
+            flag = LuxaforFlag() if LuxaforFlag is not None else None
             flag.off()
         except Exception:
             flag = None
@@ -1,21 +1,26 @@
 #!/usr/bin/python3
 
 import os
-import multiprocessing
 import time
+import atexit
+import multiprocessing
 import fluorotrace3
-import lux
-from termcolor import colored
+import geometry
+import store
+import histograms
+import sampling
+import instrument
+import telemetry
 
 
 
 NUM_WORKERS=os.cpu_count()
-print(NUM_WORKERS,"workers found".upper(),"\n"+"="*20+"\n"*3)
 #SHAPES = ["semicircle","triangle1","angled","rectangle","x"]
 SHAPES = ["tmp"+str(i) for i in range(100)]
 
 
 def welcome():
+    from termcolor import colored
     ft3 = """      ________                     ______                    _____
      / ____/ /_  ______  _________/_  __/________ _________ |__  /
     / /_  / / / / / __ \/ ___/ __ \/ / / ___/ __ `/ ___/ _ \ /_ < 
@@ -34,48 +39,341 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
-def wait_for_slot(jobs):
-    all_alive = True
-    while all_alive:
-        for job in jobs:
-            if not job.is_alive():
-                job.handled = True
-                all_alive = False
-        time.sleep(0.05)
-    return [t for t in jobs if not t.handled]
+# stages already built by this worker process, by (shape, zwalls)
+STAGES = {}
+# shared flag per shape, set by the parent once the shape has converged
+STOPPED = None
+# the worker pool, its size, its stopped flags and its telemetry counters, kept between runs (see get_pool)
+POOL = None
+# this worker's row of telemetry.COUNTERS, that the parent reads
+COUNTERS = None
+
+
+def init_worker(stopped, counters=None, next_slot=None):
+    global STOPPED
+    STOPPED = stopped
+    if counters is not None:
+        # each worker takes its own row, so no two ever write the same counters
+        with next_slot.get_lock():
+            slot = next_slot.value
+            next_slot.value += 1
+        rows = telemetry.counter_rows(counters)
+        init_counters(rows[slot] if slot < len(rows) else None)
+
+
+def init_counters(row):
+    """Publish this worker's progress in row (a telemetry.COUNTERS row, or None for nowhere) instead of printing TILE lines."""
+    global COUNTERS
+    COUNTERS = row
+    fluorotrace3.ON_CHUNK = chunk_rays
+
+
+def chunk_rays(rays):
+    # rays traced by the current task so far, on top of the worker's finished tasks
+    if COUNTERS is not None:
+        COUNTERS[2] = TASK_RAYS + rays
+
+
+TASK_RAYS = 0.0
+
+
+def get_pool(workers, slots):
+    """
+    The worker pool, its stopped flags, with at least slots flags, and the
+    telemetry.COUNTERS rows its workers publish their progress in. The
+    pool is kept for the next run, so its workers stay warm, with their
+    imports done and their stages built, and short runs do not each pay to
+    start them.
+    """
+    global POOL
+    if POOL is not None and (POOL[1] != workers or len(POOL[2]) < slots):
+        close_pool()
+    if POOL is None:
+        stopped = multiprocessing.Array("b", max(slots, 256), lock=False)
+        # rows to spare for workers the pool starts again in place of any that die
+        counters = multiprocessing.Array("d", 2 * workers * len(telemetry.COUNTERS), lock=False)
+        next_slot = multiprocessing.Value("i", 0)
+        POOL = (multiprocessing.Pool(workers, initializer=init_worker, initargs=(stopped, counters, next_slot)), workers, stopped, counters)
+    return POOL[0], POOL[2], telemetry.counter_rows(POOL[3])
+
+
+def close_pool():
+    global POOL
+    if POOL is not None:
+        POOL[0].terminate()
+        POOL[0].join()
+        POOL = None
+
+
+atexit.register(close_pool)
+
+
+def worker_stage(shape, zwalls):
+    key = (shape, tuple(zwalls))
+    if key not in STAGES:
+        STAGES[key] = fluorotrace3.get_stage(shape=shape, zwalls=zwalls)
+    return STAGES[key]
+
+
+def run_task(task):
+    """Trace one chunk of tiles of one shape, in a worker. Chunks of shapes that have converged are skipped."""
+    global TASK_RAYS
+    if STOPPED is not None and STOPPED[task["slot"]]:
+        return task["shape"], task["index"], None, None, None, None, None
+    stage = dict(worker_stage(task["shape"], task["zwalls"]))
+    stage["raypoints"] = task["tiles"]
+    stage["numradials"] = task["num_radials"]
+    stage["seed"] = task["seed"]
+    stage["sampling"] = task["sampling"]
+    stage["first_tile"] = task["first"]
+    start = time.perf_counter()
+    TASK_RAYS = COUNTERS[2] if COUNTERS is not None else 0.0
+    hists = None
+    if task["histogram"]:
+        hists = histograms.stage_histograms(stage, task["trial"]["max_steps"] * task["trial"]["step_size"])
+    result = fluorotrace3.run_trial(stage, show_single_trace=False, use_progbar=False, hists=hists, **dict(task["trial"], keep_rays=True))
+    if COUNTERS is not None:
+        COUNTERS[0] += 1
+        COUNTERS[1] += len(task["tiles"])
+        COUNTERS[2] = TASK_RAYS + stage["counts"]["rays"]
+        COUNTERS[3] += time.perf_counter() - start
+    batch = None
+    conv = sampling.stage_convergence(stage, task["tolerance"])
+    if conv is not None:
+        batch = conv.batch(result[0], result[1], stage["counts"]["rays"], *result[3:])
+    if not task["trial"]["keep_rays"]:
+        result = tuple([] for _ in result)
+    return task["shape"], task["index"], result, stage["counts"], hists, batch, stage["stats"]
+
+
+def stage_tasks(stage, tiles_per_task, trial, histogram=True, done=()):
+    """Split the raypoints of a stage into (shape, tile chunk) tasks, leaving out the chunk indices in done."""
+    tasks = []
+    for i, tiles in enumerate(chunks(stage["raypoints"], tiles_per_task)):
+        if i not in done:
+            tasks.append({"shape":stage["name"], "index":i, "first":i * tiles_per_task, "tiles":tiles,
+                          "zwalls":stage["zwalls"], "num_radials":stage["numradials"], "seed":stage["seed"],
+                          "sampling":stage["sampling"], "trial":trial, "histogram":histogram})
+    return tasks
+
+
+def make_tasks(shapes, num_raypoints, num_radials, zwalls, tiles_per_task, trial, histogram=True, seed=None, points="random", dirs="fibonacci"):
+    """Build every stage and split its raypoints into (shape, tile chunk) tasks, biggest shapes first. Unknown shapes are skipped."""
+    stages, tasks = {}, []
+    for shape in shapes:
+        try:
+            stage = fluorotrace3.get_stage(shape=shape, zwalls=zwalls)
+        except geometry.UnknownShape as e:
+            print(e, "- skipped")
+            continue
+        fluorotrace3.add_raypoints(stage, num_raypoints=num_raypoints, num_radials=num_radials, seed=seed, points=points, dirs=dirs)
+        stages[shape] = stage
+        tasks += stage_tasks(stage, tiles_per_task, trial, histogram)
+    tasks.sort(key=lambda t: -len(t["tiles"]) * t["num_radials"])
+    return stages, tasks
+
+
+def merge_counts(parts):
+    counts = None
+    for c in parts:
+        if counts is None:
+            counts = dict(c)
+        else:
+            for k in c:
+                counts[k] = counts.get(k, 0) + c[k]
+    return counts
+
+
+def merge_results(parts):
+    """Join the per chunk results of a shape (with weights, if weighted) in tile order."""
+    merged = None
+    for index in sorted(parts):
+        if merged is None:
+            merged = tuple([] for _ in parts[index])
+        for col, part in zip(merged, parts[index]):
+            col += part
+    return merged if merged is not None else ([], [], [])
+
+
+def run_shapes(shapes, num_raypoints=1000, num_radials=200, max_steps=10000, zwalls=(0,0.1), step_size=0.01,
+               engine="scalar", batch_tiles=1, cull_escapes=True, tiles_per_task=10, workers=NUM_WORKERS, save=True,
+               histogram=True, keep_rays=True, seed=None, points="random", dirs="fibonacci", tolerance=None, queue=None, weighted=False,
+               live=True, timeseries=None):
+    """
+    Trace a list of shapes on a pool of persistent worker processes. Every
+    shape is cut into chunks of tiles_per_task tiles, and idle workers take
+    the next chunk from one shared queue, so all workers stay busy whatever
+    the mix of shape sizes. With a queue directory, the chunks are shared
+    with workers on other nodes too (see run_tasks). With save, each chunk is committed to its
+    shape's store.ResultWriter as it comes back (see resume_runs) and
+    {shape: run directory} is returned; otherwise the chunks are merged in
+    memory and {shape: (endpoints, opls, enddirs)} is returned. With
+    histogram each worker also fills histograms.Histograms, merged per shape
+    and saved with the run (and left in stage["hists"]); keep_rays=False
+    keeps only those. Each shape's tiles and rays come from seed, sampled
+    as points and dirs say (see fluorotrace3.add_raypoints), so the results
+    do not depend on the number of workers. With a tolerance (see
+    sampling.Convergence) num_raypoints is a budget, and a shape's remaining
+    chunks are dropped once its targets are met; which chunks were traced
+    then depends on the order they finished in. weighted traces weighted
+    rays (see fluorotrace3.run_trial), and the results then have weights.
+    live and timeseries show and keep the workers' progress (see run_tasks).
+    """
+    trial = dict(step_size=step_size, max_steps=max_steps, engine=engine, batch_tiles=batch_tiles, cull_escapes=cull_escapes, keep_rays=keep_rays,
+                 weighted=weighted)
+    stages, tasks = make_tasks(shapes, num_raypoints, num_radials, zwalls, tiles_per_task, trial, histogram, seed, points, dirs)
+    writers = {}
+    if save:
+        params = dict(trial, num_raypoints=num_raypoints, num_radials=num_radials, tiles_per_task=tiles_per_task, histogram=histogram, tolerance=tolerance)
+        writers = {shape:store.ResultWriter(store.run_path(shape), stages[shape], params) for shape in stages}
+    return run_tasks(stages, tasks, writers, workers, {shape:tolerance for shape in stages}, queue, live, timeseries)
+
+
+def resume_runs(paths, workers=NUM_WORKERS, queue=None, live=True, timeseries=None):
+    """
+    Carry on unfinished run_shapes runs from their store directories,
+    tracing only the tile chunks that were not committed. Returns
+    {shape: run directory}.
+    """
+    stages, tasks, writers, tolerances = {}, [], {}, {}
+    for path in paths:
+        writer = store.ResultWriter.reopen(path)
+        meta, params = writer.meta, writer.meta["params"]
+        stage = fluorotrace3.get_stage(shape=meta["name"], zwalls=tuple(meta["zwalls"]))
+        if stage["compiled"]["hash"] != meta["hash"]:
+            raise ValueError("Geometry of " + meta["name"] + " has changed since " + path + " was started")
+        stage["raypoints"] = store.load_run(path)["stage"]["raypoints"].tolist()
+        stage["numradials"] = meta["numradials"]
+        stage["seed"] = meta["seed"]
+        stage["sampling"] = meta.get("sampling") or {"points":"random", "dirs":"fibonacci"}
+        stage["counts"] = writer.meta["counts"]
+        stage["hists"] = writer.hists
+        # a copy, as the writer works out each chunk's times from its own
+        stage["stats"] = instrument.merge(None, writer.meta["stats"]) if writer.meta.get("stats") else None
+        trial = {k:params[k] for k in ("step_size", "max_steps", "engine", "batch_tiles", "cull_escapes", "keep_rays")}
+        trial["weighted"] = params.get("weighted", False)
+        stages[stage["name"]] = stage
+        writers[stage["name"]] = writer
+        tolerances[stage["name"]] = params.get("tolerance")
+        tasks += stage_tasks(stage, params["tiles_per_task"], trial, params["histogram"], writer.done)
+    tasks.sort(key=lambda t: -len(t["tiles"]) * t["num_radials"])
+    return run_tasks(stages, tasks, writers, workers, tolerances, queue, live, timeseries)
+
+
+def run_tasks(stages, tasks, writers, workers=NUM_WORKERS, tolerances=None, queue=None, live=True, timeseries=None):
+    """
+    Run tasks on the worker pool, merging them into stages and committing
+    them to writers (if any) as they finish. tolerances holds the
+    sampling.Convergence targets of each shape, if any. With a queue
+    directory the tasks are published there instead, for workers on any
+    node (see distributed_fluorotrace3), workers of them started locally.
+    Workers publish their progress rather than print it; with live it is
+    shown as one line for them all (a telemetry.LiveView), and with a
+    timeseries file name it is also written there, a csv row a second.
+    """
+    slots = {shape:i for i, shape in enumerate(stages)}
+    tolerances = tolerances or {}
+    for task in tasks:
+        task["slot"] = slots[task["shape"]]
+        task["tolerance"] = tolerances.get(task["shape"])
+    tiles = sum(len(t["tiles"]) for t in tasks)
+    rays = sum(len(t["tiles"]) * t["num_radials"] for t in tasks)
+    if queue is not None:
+        import distributed_fluorotrace3
+        outputs, stop = distributed_fluorotrace3.publish(queue, tasks, workers)
+        view = telemetry.LiveView(distributed_fluorotrace3.TaskQueue(queue).counters, tiles, rays, timeseries, show=live).start()
+        try:
+            return merge_tasks(stages, tasks, outputs, writers, tolerances, stop, view)
+        finally:
+            view.stop()
+    pool, stopped, counters = get_pool(workers, len(stages))
+    stopped[:len(stages)] = [0] * len(stages)
+    view = telemetry.LiveView(lambda: dict(enumerate(counters.copy())), tiles, rays, timeseries, show=live).start()
+    try:
+        return merge_tasks(stages, tasks, pool.imap_unordered(run_task, tasks, chunksize=1), writers, tolerances,
+                           lambda shape: stopped.__setitem__(slots[shape], 1), view)
+    except BaseException:
+        # tasks may still be queued or running, so the pool cannot be used again
+        close_pool()
+        raise
+    finally:
+        view.stop()
+
+
+def merge_tasks(stages, tasks, outputs, writers, tolerances, stop, view=None):
+    """
+    Merge the outputs of run_task for tasks, in the order they come, into
+    stages and writers. stop(shape) is called once a shape has converged,
+    so its remaining tasks can be skipped, and the skipped tasks are taken
+    off the totals of the telemetry.LiveView view. Returns what run_tasks
+    does.
+    """
+    sizes = {(t["shape"], t["index"]):(len(t["tiles"]), len(t["tiles"]) * t["num_radials"]) for t in tasks}
+    convs = {shape:sampling.stage_convergence(stage, tolerances.get(shape)) for shape, stage in stages.items()}
+    remaining = {shape:0 for shape in stages}
+    for task in tasks:
+        remaining[task["shape"]] += 1
+    parts = {shape:{} for shape in stages}
+    # a resumed stage starts from the counts of its committed chunks
+    counts = {shape:[stage["counts"]] if stage.get("counts") else [] for shape, stage in stages.items()}
+
+    results = {}
+    for shape in stages:
+        if remaining[shape] == 0:
+            finish_shape(shape, stages[shape], writers, parts, counts, results, convs[shape])
+    for shape, index, result, chunk_counts, hists, batch, stats in outputs:
+        stage = stages[shape]
+        remaining[shape] -= 1
+        if result is None:
+            # skipped, the shape had already converged
+            if view is not None:
+                view.skip(*sizes[shape, index])
+            if remaining[shape] == 0:
+                finish_shape(shape, stage, writers, parts, counts, results, convs[shape])
+            continue
+        if batch is not None:
+            convs[shape].add_batch(batch)
+            if convs[shape].done():
+                stop(shape)
+        counts[shape].append(chunk_counts)
+        stage["counts"] = merge_counts(counts[shape])
+        stage["stats"] = instrument.merge(stage.get("stats"), stats)
+        with instrument.timer(stage["stats"], "save"):
+            if hists is not None:
+                if stage.get("hists") is None:
+                    stage["hists"] = hists
+                else:
+                    stage["hists"].merge(hists)
+            if shape in writers:
+                writers[shape].append(*result, chunk=index, counts=stage["counts"], hists=stage.get("hists"), stats=stage["stats"])
+            else:
+                parts[shape][index] = result
+        if remaining[shape] == 0:
+            finish_shape(shape, stage, writers, parts, counts, results, convs[shape])
+    return results
+
+
+def finish_shape(shape, stage, writers, parts, counts, results, conv=None):
+    stage["counts"] = merge_counts(counts[shape])
+    if stage.get("stats") and stage["counts"]:
+        print(shape + ":", instrument.summary(stage["stats"], stage["counts"]))
+    if conv is not None:
+        stage["convergence"] = conv.report()
+    if shape in writers:
+        writers[shape].close(stage["counts"], stage.get("hists"), convergence=stage.get("convergence"), stats=stage.get("stats"))
+        results[shape] = writers[shape].path
+    else:
+        results[shape] = merge_results(parts.pop(shape))
 
 
 def main():
     welcome()
+    print(NUM_WORKERS,"workers found".upper(),"\n"+"="*20+"\n"*3)
+    import lux
     f = lux.Flag()
     f.busy()
 
-    if len(SHAPES) > NUM_WORKERS-1:
-        print("Too many geometries! Not enough workers.")
-        print("Splitting List...")
-
-    jobs = []
-    for i, shape in enumerate(SHAPES):
-        if i >= NUM_WORKERS-1:
-            jobs = wait_for_slot(jobs)
-        else:
-            pass
-
-        job = multiprocessing.Process(target=fluorotrace3.external_run,
-                            kwargs=dict(shape=shape,
-                                num_raypoints=1000,
-                                num_radials=200,
-                                max_steps=10000,
-                                zwalls=(0,0.1),
-                                step_size=0.01
-                               )
-                            )
-        job.handled = False
-        job.start()
-        jobs.append(job)
-
-    for job_ in jobs:
-        job_.join()
+    run_shapes(SHAPES, num_raypoints=1000, num_radials=200, max_steps=10000, zwalls=(0,0.1), step_size=0.01)
 
     f.ready()
 
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+import json
+import random
+
+import numpy as np
+
+import tracer
+import store
+import fluorotrace3
+from histograms import binned_counts, exit_angles
+
+# emission cells traced together in one tracer call
+CELLS_PER_TRACE = 64
+
+
+class ResponseTable:
+    """
+    Detector response of a stage to emission from each cell of a regular
+    (nx, ny, nz) grid over it: the rays launched from the cell, the weight
+    (count, unless weighted) and OPL sum of those detected, and histograms
+    of their OPL, detector position and exit angle, with the fraction of
+    the cell inside the stage. trace_response makes one, tracing once;
+    evaluate then folds any emission density over the cells with it, with
+    no tracing at all.
+    """
+    def __init__(self, edges, fill, meta=None):
+        # "x", "y", "z" cell edges, and the "opl", "pos" and "angle" bin edges
+        self.edges = edges
+        self.shape = tuple(len(edges[k]) - 1 for k in ("x", "y", "z"))
+        n = int(np.prod(self.shape))
+        self.fill = np.asarray(fill, dtype=float).ravel()
+        self.rays = np.zeros(n)
+        self.detected = np.zeros(n)
+        self.opl_sum = np.zeros(n)
+        self.counts = {k:np.zeros((n, len(edges[k]) - 1)) for k in ("opl", "pos", "angle")}
+        self.meta = meta or {}
+
+    def add(self, launched, cell, ends, opls, enddirs, weights=None):
+        """
+        Add launched rays per cell, and the detected ones: the cell each came
+        from, its endpoint, OPL and exit direction (and weight).
+        """
+        n = len(self.rays)
+        self.rays += launched
+        if not len(opls):
+            return
+        w = np.ones(len(opls)) if weights is None else np.asarray(weights, dtype=float)
+        self.detected += np.bincount(cell, weights=w, minlength=n)
+        self.opl_sum += np.bincount(cell, weights=w * opls, minlength=n)
+        # cell numbers binned over edges 0..n, offset onto the bin centres
+        x, cells = cell + 0.5, np.arange(n + 1)
+        self.counts["opl"] += binned_counts(x, opls, cells, self.edges["opl"], w)
+        self.counts["pos"] += binned_counts(x, ends[:, 1], cells, self.edges["pos"], w)
+        # each exit angle and its mirror image, as histograms.Histograms keeps them
+        angles = exit_angles(enddirs)
+        self.counts["angle"] += binned_counts(np.tile(x, 2), np.concatenate([angles, -angles]), cells, self.edges["angle"], np.tile(w, 2))
+
+    def centres(self):
+        """x, y and z of every cell centre, each an array of the grid's shape."""
+        mids = [0.5 * (self.edges[k][1:] + self.edges[k][:-1]) for k in ("x", "y", "z")]
+        return np.meshgrid(*mids, indexing="ij")
+
+    def probability(self):
+        """Collection probability of each cell (detected weight per ray launched), nan where none were."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (self.detected / self.rays).reshape(self.shape)
+
+    def evaluate(self, density):
+        """
+        Response to the emission density over the stage, any units per unit
+        volume: an array of the grid's shape, or (nx, ny) for the same
+        density at every height, or a function of the cell centres' x, y
+        and z arrays. Returns the collection efficiency (detected per
+        emitted ray), the mean OPL of detected rays, and the "opl", "pos"
+        and "angle" distributions of detected rays per emitted ray (the
+        angle one counting each ray twice, with its mirror image), with
+        their bin "edges".
+        """
+        if callable(density):
+            rho = np.asarray(density(*self.centres()), dtype=float)
+        else:
+            rho = np.asarray(density, dtype=float)
+            if rho.ndim == 2:
+                rho = np.repeat(rho[..., None], self.shape[2], axis=2)
+        # every cell has the same volume, so the emission of each is density times the part inside
+        emitted = np.broadcast_to(rho, self.shape).ravel() * self.fill
+        total = emitted.sum()
+        if not total:
+            raise ValueError("Emission density is zero inside the stage")
+        # weight of each ray traced from a cell, per emitted ray
+        w = np.where(self.rays > 0, emitted / np.maximum(self.rays, 1), 0) / total
+        efficiency = float(w @ self.detected)
+        result = {"efficiency":efficiency,
+                  "mean_opl":float(w @ self.opl_sum) / efficiency if efficiency else np.nan,
+                  "edges":{k:self.edges[k] for k in ("opl", "pos", "angle")}}
+        result.update({k:w @ v for k, v in self.counts.items()})
+        return result
+
+    def to_arrays(self):
+        arrs = {"edges_" + k:v for k, v in self.edges.items()}
+        arrs.update({"counts_" + k:v for k, v in self.counts.items()})
+        arrs.update(fill=self.fill, rays=self.rays, detected=self.detected, opl_sum=self.opl_sum, meta=np.array(json.dumps(self.meta)))
+        return arrs
+
+    @classmethod
+    def from_arrays(cls, arrs):
+        table = cls({k[6:]:np.asarray(v) for k, v in arrs.items() if k.startswith("edges_")}, arrs["fill"], json.loads(str(arrs["meta"])))
+        table.counts = {k[7:]:np.array(v) for k, v in arrs.items() if k.startswith("counts_")}
+        table.rays, table.detected, table.opl_sum = np.array(arrs["rays"]), np.array(arrs["detected"]), np.array(arrs["opl_sum"])
+        return table
+
+    def save(self, fname):
+        np.savez_compressed(fname, **self.to_arrays())
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            return cls.from_arrays(dict(f))
+
+
+def cell_points(edges, cstage, points_per_cell, seed):
+    """
+    Up to points_per_cell emission points in each cell, uniform over the
+    part of it inside the stage, as a list per cell, and the fraction of
+    each cell inside, both estimated from the same uniform candidates.
+    """
+    rng = np.random.default_rng(seed)
+    lo = np.stack(np.meshgrid(edges["x"][:-1], edges["y"][:-1], edges["z"][:-1], indexing="ij"), axis=-1).reshape(-1, 3)
+    size = np.array([edges[k][1] - edges[k][0] for k in ("x", "y", "z")])
+    tries = max(4 * points_per_cell, 64)
+    pts = lo[:, None, :] + rng.random((len(lo), tries, 3)) * size
+    inside = tracer.points_in_polygon(pts[..., 0].ravel(), pts[..., 1].ravel(), cstage["start"], cstage["end"],
+                                      cstage["grid"], cstage["arcs"]).reshape(len(lo), tries)
+    return [p[ok][:points_per_cell] for p, ok in zip(pts, inside)], inside.mean(axis=1)
+
+
+def trace_response(stage, cells=(40, 20, 1), points_per_cell=16, num_radials=64, engine="exact", step_size=0.01, max_steps=10000,
+                   cull_escapes=True, weighted=False, seed=None, opl_bins=500, pos_bins=100, angle_bins=90, use_progbar=True):
+    """
+    Trace the stage once into a ResponseTable over cells (nx, ny, nz)
+    spanning its outline and z walls: points_per_cell emission points in
+    each cell, each with num_radials directions, traced with the "exact" or
+    "batch" engine as run_trial would (weighted rays too). Everything random
+    comes from seed, as for fluorotrace3.add_raypoints.
+    """
+    if engine not in ("exact", "batch"):
+        raise ValueError("Response tables are traced with the exact or batch engine, not " + str(engine))
+    c = stage["compiled"]
+    lo, hi = tracer.stage_bounds(c)
+    max_opl = max_steps * step_size
+    edges = {"x":np.linspace(lo[0], hi[0], cells[0] + 1),
+             "y":np.linspace(lo[1], hi[1], cells[1] + 1),
+             "z":np.linspace(c["zwalls"][0], c["zwalls"][1], cells[2] + 1),
+             "opl":np.linspace(0, max_opl, opl_bins + 1),
+             "pos":np.linspace(lo[1], hi[1], pos_bins + 1),
+             "angle":np.linspace(-90, 90, angle_bins + 1)}
+    if seed is None:
+        seed = random.getrandbits(63)
+    points, fill = cell_points(edges, c, points_per_cell, random.Random("{}:{}:response".format(seed, stage["name"])).getrandbits(63))
+
+    # every emission point is a tile of its own, with directions as run_trial gives them
+    traced = dict(stage, raypoints=[p for ps in points for p in ps], numradials=num_radials, seed=seed,
+                  sampling={"points":"cells", "dirs":"fibonacci"}, first_tile=0)
+    traced["counts"] = fluorotrace3.new_counts()
+    table = ResponseTable(edges, fill)
+    first = np.cumsum([0] + [len(ps) for ps in points])
+    for k in fluorotrace3.progress(range(0, len(points), CELLS_PER_TRACE), use_progbar):
+        ks = np.arange(k, min(k + CELLS_PER_TRACE, len(points)))
+        if first[ks[-1] + 1] == first[ks[0]]:
+            continue
+        tiles = np.array(traced["raypoints"][first[ks[0]]:first[ks[-1] + 1]], dtype=float)
+        cell = np.repeat(np.repeat(ks, [len(points[i]) for i in ks]), num_radials)
+        pos = np.repeat(tiles, num_radials, axis=0)
+        dirs = fluorotrace3.tile_raydirs(traced, first[ks[0]], len(tiles)).reshape(-1, 3)
+        keep = np.ones(len(pos), dtype=bool)
+        if cull_escapes and not weighted:
+            margin = 0 if engine == "exact" else step_size
+            keep = ~tracer.escape_cone_culled(pos, dirs, c, crit_angle=fluorotrace3.CRIT_ANGLE, margin=margin)
+        fresnel = fluorotrace3.fresnel_indices(weighted)
+        if engine == "exact":
+            res = tracer.trace_rays(pos[keep], dirs[keep], c, max_opl=max_opl, crit_angle=fluorotrace3.CRIT_ANGLE, fresnel=fresnel)
+            good, steps = res["detected"], 0
+        else:
+            res = tracer.march_rays(pos[keep], dirs[keep], c, dl=step_size, max_steps=max_steps, crit_angle=fluorotrace3.CRIT_ANGLE, fresnel=fresnel)
+            good, steps = res["detected"] & (res["pathlen"] > 3), res["pathlen"].sum()
+        weights = res["weight"][good] if weighted else None
+        fluorotrace3.count_status(traced, res["status"], len(pos) - len(res["status"]), steps, None if weights is None else weights.sum())
+        table.add(np.bincount(cell, minlength=len(points)), cell[keep][good], res["end"][good], res["opl"][good], res["enddir"][good], weights)
+
+    table.meta = {"name":stage["name"], "hash":c["hash"], "zwalls":list(c["zwalls"]), "cells":list(cells), "points_per_cell":points_per_cell,
+                  "num_radials":num_radials, "engine":engine, "step_size":step_size, "max_steps":max_steps, "cull_escapes":cull_escapes,
+                  "weighted":weighted, "seed":seed, "counts":traced["counts"]}
+    return table
+
+
+def external_response(shape="", zwalls=(0,0.1), **kwargs):
+    """trace_response for a shape, saved next to the runs in ./data. Returns the file name."""
+    if shape != "":
+        stage = fluorotrace3.get_stage(shape=shape, zwalls=zwalls)
+        table = trace_response(stage, use_progbar=False, **kwargs)
+        fname = store.run_path("response-" + shape) + ".npz"
+        table.save(fname)
+        return fname
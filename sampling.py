@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+import warnings
+
+import numpy as np
+
+import tracer
+import store
+
+# ways of filling the emission volume, and of picking each tile's directions
+# ("fibonacci" is fluorotrace3.random_fibonacci_sphere, a randomly rotated lattice)
+POINT_MODES = ["random", "stratified", "halton", "sobol"]
+DIR_MODES = ["fibonacci", "random", "stratified", "halton", "sobol"]
+
+
+def unit_samples(n, dims, mode="random", seed=None):
+    """
+    n points in the unit cube [0, 1)^dims. "random" is plain Monte Carlo,
+    "stratified" puts each point in its own cell of a regular grid (cells in
+    random order), "halton" and "sobol" are scrambled low discrepancy
+    sequences. The scrambling and jitter all come from seed, and except for
+    "stratified" a larger n from the same seed starts with the same points.
+    """
+    # scipy.stats is slow to import, so workers only load it for the modes that use it
+    if mode == "random":
+        return np.random.default_rng(seed).random((n, dims))
+    elif mode == "stratified":
+        rng = np.random.default_rng(seed)
+        k = int(np.ceil(n ** (1 / dims) - 1e-9))
+        cells = rng.permutation(k ** dims)[:n]
+        index = np.stack(np.unravel_index(cells, (k,) * dims), axis=1)
+        return (index + rng.random((n, dims))) / k
+    elif mode == "halton":
+        from scipy.stats import qmc
+        return qmc.Halton(dims, scramble=True, seed=seed).random(n)
+    elif mode == "sobol":
+        with warnings.catch_warnings():
+            # only a power of two count keeps every balance property, but any prefix is still fine
+            warnings.simplefilter("ignore", UserWarning)
+            from scipy.stats import qmc
+            return qmc.Sobol(dims, scramble=True, seed=seed).random(n)
+    raise ValueError("Unknown sampling mode " + str(mode))
+
+
+def sphere_points(u):
+    """Map points of the unit square onto the unit sphere, keeping areas equal."""
+    z = 1 - 2 * u[:, 0]
+    r = np.sqrt(np.maximum(0, 1 - z * z))
+    phi = 2 * np.pi * u[:, 1]
+    return np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=1)
+
+
+def sphere_samples(n, mode="sobol", seed=None):
+    return sphere_points(unit_samples(n, 2, mode, seed))
+
+
+def volume_samples(n, stage, mode="sobol", seed=None):
+    """
+    n emission points inside the stage outline, between its z walls: the
+    sequence of mode over the bounding box, keeping the first n that land
+    inside the outline. "stratified" is stratified_volume_samples, as the
+    first n of its cells inside would be a random subset of the strata.
+    """
+    c = stage["compiled"]
+    lo = np.array([stage["xrange"][0], stage["yrange"][0], stage["zrange"][0]], dtype=float)
+    hi = np.array([stage["xrange"][1], stage["yrange"][1], stage["zrange"][1]], dtype=float)
+    if mode == "stratified":
+        return stratified_volume_samples(n, stage, lo, hi, seed)
+    tries = 2 * n + 16
+    while True:
+        pts = lo + unit_samples(tries, 3, mode, seed) * (hi - lo)
+        inside = tracer.points_in_polygon(pts[:, 0], pts[:, 1], c["start"], c["end"], c["grid"], c["arcs"])
+        if np.count_nonzero(inside) >= n:
+            return pts[inside][:n]
+        tries *= 2
+
+
+def stratified_volume_samples(n, stage, lo, hi, seed=None):
+    """
+    n points of the stage between the corners lo and hi of its bounding
+    box, stratified over the part inside: a jittered point in each cell of
+    a k x k x k grid over the box, k the smallest putting at least n inside
+    (starting from the outline's share of the box), and every one of those
+    kept but for an even thinning, in cell order, down to n.
+    """
+    c = stage["compiled"]
+    rng = np.random.default_rng(seed)
+    share = stage["polygon"].area / ((hi[0] - lo[0]) * (hi[1] - lo[1]))
+    k = max(1, int(np.ceil((n / share) ** (1 / 3))))
+    while True:
+        index = np.stack(np.unravel_index(np.arange(k ** 3), (k,) * 3), axis=1)
+        pts = lo + (index + rng.random((k ** 3, 3))) / k * (hi - lo)
+        inside = tracer.points_in_polygon(pts[:, 0], pts[:, 1], c["start"], c["end"], c["grid"], c["arcs"])
+        if np.count_nonzero(inside) >= n:
+            break
+        k += 1
+    pts = pts[inside]
+    return pts[np.floor((np.arange(n) + rng.random()) * len(pts) / n).astype(int)]
+
+
+def ratio_error(y, x):
+    """
+    sum(y) / sum(x) and its standard error, from k independent batch
+    totals y[i], x[i] (the ratio estimator). nan error for fewer than 2.
+    """
+    y, x = np.asarray(y, dtype=float), np.asarray(x, dtype=float)
+    ratio = y.sum() / x.sum() if x.sum() else np.nan
+    k = len(x)
+    if k < 2:
+        return ratio, np.nan
+    return ratio, np.sqrt(np.sum((y - ratio * x) ** 2) / (k * (k - 1))) / x.mean()
+
+
+def batch_errors(rows, rays, opl_sums):
+    """
+    Collection efficiency (detected rays / rays) and mean OPL of a run, with
+    standard errors, from the per batch (tile chunk) totals. For weighted
+    rays, rows and opl_sums are the summed weights and weighted OPLs. Batches of
+    low discrepancy tiles are not quite independent, so for those modes
+    this overstates the error; compare modes with replicate runs instead.
+    """
+    eff, eff_err = ratio_error(rows, rays)
+    opl, opl_err = ratio_error(opl_sums, rows)
+    return {"efficiency":eff, "efficiency_err":eff_err, "mean_opl":opl, "mean_opl_err":opl_err, "batches":len(rays)}
+
+
+def run_errors(path):
+    """batch_errors for a run saved in the store directory path, a batch per committed chunk, weighted if the run was."""
+    data = store.load_run(path)
+    chunks = data["meta"]["chunks"]
+    if not chunks or any(len(c) < 4 or c[3] is None for c in chunks):
+        raise ValueError("Run has no per chunk ray counts")
+    starts = np.array([c[1] for c in chunks], dtype=int)
+    rows = np.array([c[2] for c in chunks], dtype=int)
+    rays = np.array([c[3] for c in chunks], dtype=int)
+    opls = np.asarray(data["opls"], dtype=float)
+    weights = np.asarray(data["weight"], dtype=float).ravel() if "weight" in data else np.ones(len(opls))
+    sums = np.array([np.dot(weights[s:s + n], opls[s:s + n]) for s, n in zip(starts, rows)])
+    detected = np.array([weights[s:s + n].sum() for s, n in zip(starts, rows)])
+    return batch_errors(detected, rays, sums)
+
+
+class Convergence:
+    """
+    Stopping rule for a trial traced in batches (tile chunks). tolerance
+    holds the targets, any of: "efficiency" and "mean_opl", the largest
+    confidence interval half-widths allowed, "hist", the largest total
+    variation distance between the detector position histograms of the odd
+    and even batches, and "max_rays", a budget after which the trial stops
+    anyway. Without any of the first three it never converges, and only
+    the budget stops it. "confidence" (0.95) and "min_batches" (8) can be set too.
+    """
+    def __init__(self, tolerance, yrange=(0, 1), bins=20):
+        from scipy.stats import norm
+        self.tolerance = dict(tolerance)
+        self.z = norm.ppf(0.5 + self.tolerance.get("confidence", 0.95) / 2)
+        self.min_batches = self.tolerance.get("min_batches", 8)
+        self.edges = np.linspace(yrange[0], yrange[1], bins + 1)
+        self.halves = np.zeros((2, bins))
+        self.rows, self.rays, self.opl_sums = [], [], []
+
+    def batch(self, endpoints, opls, rays, weights=None):
+        """Totals of one batch, from its detected endpoints, OPLs (and weights) and the number of rays traced for it."""
+        ends = np.asarray(endpoints, dtype=float).reshape(-1, 3)
+        if weights is None:
+            return len(ends), int(rays), float(np.sum(opls)), np.histogram(ends[:, 1], self.edges)[0]
+        w = np.asarray(weights, dtype=float).ravel()
+        return float(w.sum()), int(rays), float(np.dot(w, np.asarray(opls, dtype=float).ravel())), np.histogram(ends[:, 1], self.edges, weights=w)[0]
+
+    def add_batch(self, batch):
+        """Add the totals of a batch, made by batch() here or in another process."""
+        rows, rays, opl_sum, pos = batch
+        self.halves[len(self.rows) % 2] += pos
+        self.rows.append(rows)
+        self.rays.append(rays)
+        self.opl_sums.append(opl_sum)
+
+    def add(self, endpoints, opls, rays, weights=None):
+        self.add_batch(self.batch(endpoints, opls, rays, weights))
+
+    def hist_distance(self):
+        totals = self.halves.sum(axis=1, keepdims=True)
+        if not np.all(totals):
+            return np.inf
+        return 0.5 * np.abs(self.halves[0] / totals[0] - self.halves[1] / totals[1]).sum()
+
+    def report(self):
+        errs = batch_errors(self.rows, self.rays, self.opl_sums)
+        errs.update({"efficiency_half_width":self.z * errs["efficiency_err"],
+                     "mean_opl_half_width":self.z * errs["mean_opl_err"],
+                     "hist_distance":self.hist_distance(),
+                     "rays":int(np.sum(self.rays)),
+                     "tolerance":self.tolerance})
+        # a budget alone is never converged, the trial only stops when it is spent
+        met = [value <= self.tolerance[k] for k, value in (("efficiency", errs["efficiency_half_width"]),
+                                                          ("mean_opl", errs["mean_opl_half_width"]),
+                                                          ("hist", errs["hist_distance"])) if k in self.tolerance]
+        errs["converged"] = bool(met) and len(self.rows) >= self.min_batches and all(met)
+        errs["budget_spent"] = bool("max_rays" in self.tolerance and errs["rays"] >= self.tolerance["max_rays"])
+        return {k:(float(v) if isinstance(v, np.floating) else v) for k, v in errs.items()}
+
+    def done(self):
+        r = self.report()
+        return r["converged"] or r["budget_spent"]
+
+
+def stage_convergence(stage, tolerance):
+    """Convergence for a stage, with the position bins over its y range; None if there are no targets."""
+    if not tolerance:
+        return None
+    c = stage["compiled"]
+    lo, hi = tracer.stage_bounds(c)
+    return Convergence(tolerance, yrange=(lo[1], hi[1]))
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+import os
+import re
+import json
+import pickle
+import datetime
+
+import numpy as np
+
+import tracer
+import histograms
+import instrument
+
+VERSION = 1
+# old whole-run pickles, as save_data wrote them before this store
+PICKLE_NAME = re.compile(r"^data-(.*)-\d{4}-\d\d-\d\d_\d\d:\d\d:\d\d\.pickle$")
+# per ray result columns, all little endian float64: columns per row
+FIELDS = {"ends":3, "opls":1, "dir":3}
+# and for weighted runs (params "weighted"), the weight of each ray
+WEIGHT_FIELDS = {"weight":1}
+
+
+def run_path(name, root="./data"):
+    path = os.path.join(root, "data-" + name + "-{date:%Y-%m-%d_%H:%M:%S}".format(date=datetime.datetime.now()))
+    i, unique = 1, path
+    while os.path.exists(unique):
+        unique, i = path + "-" + str(i), i + 1
+    return unique
+
+
+def write_json(fname, obj):
+    # write then rename, so a crash never leaves a half written header
+    with open(fname + ".tmp", "w") as f:
+        json.dump(obj, f, indent=1)
+    os.replace(fname + ".tmp", fname)
+
+
+class ResultWriter:
+    """
+    Columnar on-disk results for one stage. Each field of FIELDS is a raw
+    append-only array file, written a chunk at a time while the trial runs.
+    meta.json holds the header (stage hash, run parameters, seed, counts)
+    and the chunks committed so far, so a killed run keeps every chunk that
+    was finished and can be carried on with ResultWriter.reopen. Runs with
+    params["weighted"] have the WEIGHT_FIELDS too.
+    """
+    def __init__(self, path, stage, params=None):
+        os.makedirs(path)
+        self.path = path
+        fields = dict(FIELDS, **WEIGHT_FIELDS) if (params or {}).get("weighted") else FIELDS
+        self.meta = {"version":VERSION,
+                     "name":stage["name"],
+                     "zwalls":list(stage["zwalls"]),
+                     "numradials":stage.get("numradials"),
+                     "hash":stage["compiled"]["hash"],
+                     "seed":stage.get("seed"),
+                     "sampling":stage.get("sampling"),
+                     "params":params or {},
+                     "fields":{k:{"dtype":"<f8", "cols":c} for k, c in fields.items()},
+                     "rows":0,
+                     "chunks":[],
+                     "counts":None,
+                     "hists":None,
+                     "stats":None,
+                     "complete":False}
+        self.done, self.hists = set(), None
+        with open(os.path.join(path, "stage.npz"), "wb") as f:
+            f.write(tracer.pack_stage(stage["compiled"]))
+        np.save(os.path.join(path, "raypoints.npy"), np.array(stage.get("raypoints", []), dtype=float))
+        self.files = {k:open(os.path.join(path, k + ".f8"), "ab") for k in fields}
+        write_json(os.path.join(path, "meta.json"), self.meta)
+
+    @classmethod
+    def reopen(cls, path):
+        """
+        Open an unfinished run to append to again. Anything written past the
+        last committed chunk is cut off; self.done holds the chunk ids
+        already finished and self.hists their histograms, if any.
+        """
+        writer = cls.__new__(cls)
+        writer.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            writer.meta = json.load(f)
+        writer.meta["complete"] = False
+        writer.done = set(c[0] for c in writer.meta["chunks"])
+        writer.hists = None
+        if writer.meta.get("hists"):
+            with np.load(os.path.join(path, writer.meta["hists"])) as f:
+                writer.hists = histograms.Histograms.from_arrays(dict(f))
+        for fname in os.listdir(path):
+            if fname.startswith("hists") and fname != writer.meta.get("hists"):
+                os.remove(os.path.join(path, fname))
+        writer.files = {}
+        for k, spec in writer.meta["fields"].items():
+            fname = os.path.join(path, k + ".f8")
+            os.truncate(fname, writer.meta["rows"] * spec["cols"] * 8)
+            writer.files[k] = open(fname, "ab")
+        return writer
+
+    def append(self, endpoints, opls, enddirs, weights=None, chunk=None, counts=None, hists=None, stats=None):
+        """
+        Write one chunk of results and commit it, with the run's counts,
+        histograms.Histograms and instrument stats so far if given, so they
+        always match the committed chunks. weights are needed by (and only
+        kept for) weighted runs.
+        """
+        rows = len(opls)
+        cols = {"ends":endpoints, "opls":opls, "dir":enddirs, "weight":weights}
+        for k, spec in self.meta["fields"].items():
+            arr = np.asarray(cols[k], dtype="<f8").reshape(rows, spec["cols"])
+            self.files[k].write(arr.tobytes())
+            self.files[k].flush()
+        # rays traced for the chunk and its sampling and tracing seconds, from the running totals
+        rays, times = None, None
+        if counts is not None:
+            rays = counts["rays"] - (self.meta["counts"] or {}).get("rays", 0)
+        if stats is not None:
+            times = instrument.chunk_times(stats, self.meta.get("stats"))
+        self.meta["chunks"].append([chunk, self.meta["rows"], rows, rays, times])
+        self.meta["rows"] += rows
+        self.done.add(chunk)
+        self.commit(counts, hists, stats)
+
+    def commit(self, counts=None, hists=None, stats=None):
+        old = self.meta["hists"]
+        if hists is not None:
+            # a new file per commit, so meta.json never names a half written one
+            self.meta["hists"] = "hists-" + str(int(old[6:-4]) + 1 if old else 0) + ".npz"
+            np.savez(os.path.join(self.path, self.meta["hists"]), **hists.to_arrays())
+        if counts is not None:
+            self.meta["counts"] = dict(counts)
+        if stats is not None:
+            self.meta["stats"] = instrument.merge(None, stats)
+        write_json(os.path.join(self.path, "meta.json"), self.meta)
+        if old is not None and old != self.meta["hists"]:
+            os.remove(os.path.join(self.path, old))
+
+    def close(self, counts=None, hists=None, stats=None, **info):
+        """
+        Finish the run, storing its counts, histograms.Histograms and
+        instrument stats, and any other header entries in info (such as a
+        convergence report). Safe to call again.
+        """
+        for f in self.files.values():
+            f.close()
+        self.meta.update(info)
+        self.meta["complete"] = True
+        self.commit(counts, hists, stats)
+
+
+def load_run(path, mmap=True, ordered=False):
+    """
+    Read a run written by ResultWriter into the same dict layout the old
+    pickles had ("ends", "opls", "dir", "stage"), plus its "meta" header and
+    "hists" (a histograms.Histograms, or None). Columns are memory mapped
+    unless mmap is False. Rows are in the order the chunks finished; with
+    ordered they are sorted by chunk id instead (and read into memory), so
+    runs done with any number of workers compare equal.
+    """
+    if os.path.basename(path) == "meta.json":
+        path = os.path.dirname(path)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    rows = meta["rows"]
+    data = {"meta":meta}
+    order = None
+    if ordered:
+        chunks = sorted(meta["chunks"], key=lambda c: -1 if c[0] is None else c[0])
+        order = np.concatenate([np.arange(c[1], c[1] + c[2]) for c in chunks] + [np.zeros(0, dtype=int)])
+    for k, spec in meta["fields"].items():
+        fname = os.path.join(path, k + ".f8")
+        shape = (rows, spec["cols"])
+        if rows == 0:
+            arr = np.zeros(shape)
+        elif mmap:
+            arr = np.memmap(fname, dtype=spec["dtype"], mode="r", shape=shape)
+        else:
+            arr = np.fromfile(fname, dtype=spec["dtype"], count=rows * spec["cols"]).reshape(shape)
+        if order is not None:
+            arr = np.asarray(arr[order])
+        data[k] = arr[:, 0] if spec["cols"] == 1 else arr
+
+    data["hists"] = None
+    if meta.get("hists"):
+        with np.load(os.path.join(path, meta["hists"])) as f:
+            data["hists"] = histograms.Histograms.from_arrays(dict(f))
+
+    with open(os.path.join(path, "stage.npz"), "rb") as f:
+        compiled = f.read()
+    data["stage"] = {"name":meta["name"],
+                     "zwalls":tuple(meta["zwalls"]),
+                     "numradials":meta["numradials"],
+                     "raypoints":np.load(os.path.join(path, "raypoints.npy"), mmap_mode="r" if mmap else None),
+                     "counts":meta["counts"],
+                     "seed":meta.get("seed"),
+                     "sampling":meta.get("sampling"),
+                     "compiled":compiled,
+                     "hash":meta["hash"]}
+    return data
+
+
+def index_runs(root="./data"):
+    """
+    Headers of every run in root, without reading any rays: store run
+    directories ("format" "store", with their "meta") and old whole-run
+    pickles ("format" "pickle", named by their file name only), sorted by
+    path.
+    """
+    runs = []
+    for fname in sorted(os.listdir(root)):
+        path = os.path.join(root, fname)
+        if os.path.isfile(os.path.join(path, "meta.json")):
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+            runs.append({"path":path, "format":"store", "name":meta["name"], "zwalls":tuple(meta["zwalls"]),
+                         "rows":meta["rows"], "complete":meta["complete"], "meta":meta})
+        elif PICKLE_NAME.match(fname):
+            runs.append({"path":path, "format":"pickle", "name":PICKLE_NAME.match(fname).group(1), "zwalls":None,
+                         "rows":None, "complete":True, "meta":None})
+    return runs
+
+
+def iter_columns(run, fields=("ends", "opls", "dir"), chunk=1000000):
+    """
+    Yield the fields of a run from index_runs chunk rows at a time, as dicts
+    of arrays. Store runs are read from their memory mapped columns, so only
+    a chunk is in memory at once; pickles can only be read whole first.
+    """
+    if run["format"] == "store":
+        data = load_run(run["path"])
+    else:
+        with open(run["path"], "rb") as f:
+            data = pickle.load(f)
+    rows = len(data["opls"])
+    for i in range(0, rows, chunk):
+        yield {k:np.asarray(data[k][i:i + chunk], dtype=float) for k in fields}
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+import sys
+import time
+import datetime
+import threading
+
+import numpy as np
+
+# what each worker publishes, as one row of floats: tasks, tiles and rays done, and seconds spent on tasks
+COUNTERS = ["tasks", "tiles", "rays", "busy"]
+# seconds between redraws of the live view, and between its lines when it is not on a terminal
+INTERVAL = 1.0
+LOG_INTERVAL = 30.0
+# seconds of samples the rays per second (and so the time left) are taken over
+RATE_WINDOW = 10.0
+
+
+def counter_rows(buffer):
+    """A shared array (or any buffer) of worker counters, as a (workers, len(COUNTERS)) float array over it."""
+    return np.frombuffer(buffer, dtype=float).reshape(-1, len(COUNTERS))
+
+
+def eta_string(seconds):
+    if not np.isfinite(seconds):
+        return "--:--:--"
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class LiveView:
+    """
+    One line of progress for all the workers of a run: tiles and rays done
+    out of the total, rays per second and time left, redrawn on stderr
+    every interval seconds by a thread of its own (or printed every
+    LOG_INTERVAL seconds when stderr is not a terminal). sample() returns
+    the workers' COUNTERS rows as {worker: row}, from wherever they publish
+    them; what they had already done when the view started is taken off.
+    With a timeseries file name, every sample is also appended there as a
+    csv row, for looking at throughput afterwards; show=False keeps only
+    that.
+    """
+    def __init__(self, sample, tiles, rays, timeseries=None, interval=INTERVAL, stream=None, show=True):
+        self.sample = sample
+        self.show = show
+        self.tiles, self.rays = tiles, rays
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        self.baseline = {k:np.array(v) for k, v in sample().items()}
+        self.start_time = self.logged = time.time()
+        self.history = [(self.start_time, 0.0)]
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = None
+        self.series = None
+        if timeseries is not None:
+            self.series = open(timeseries, "a")
+            if self.series.tell() == 0:
+                self.series.write("time,elapsed,workers," + ",".join(COUNTERS) + ",total_tiles,total_rays,rays_per_sec,eta\n")
+
+    def skip(self, tiles, rays):
+        """Take tiles and rays that will not be traced (their shape converged) off the totals."""
+        with self.lock:
+            self.tiles -= tiles
+            self.rays -= rays
+
+    def totals(self):
+        """Sums of the COUNTERS over the workers since the view started, and how many workers have done anything."""
+        rows = [np.asarray(v) - self.baseline.get(k, 0) for k, v in self.sample().items()]
+        rows = [r for r in rows if np.any(r)]
+        return (np.sum(rows, axis=0) if rows else np.zeros(len(COUNTERS))), len(rows)
+
+    def poll(self):
+        now = time.time()
+        totals, workers = self.totals()
+        tasks, tiles, rays, busy = totals
+        self.history.append((now, rays))
+        while len(self.history) > 2 and now - self.history[1][0] > RATE_WINDOW:
+            self.history.pop(0)
+        t0, r0 = self.history[0]
+        rate = (rays - r0) / (now - t0) if now > t0 else 0.0
+        with self.lock:
+            total_tiles, total_rays = self.tiles, self.rays
+        eta = max(total_rays - rays, 0) / rate if rate > 0 else np.inf
+        line = "{:.0f}/{:.0f} tiles, {:.3g}/{:.3g} rays, {:.3g} rays/s, {} workers, ETA {}".format(
+            tiles, total_tiles, rays, total_rays, rate, workers, eta_string(eta))
+        if self.show and self.tty:
+            self.stream.write("\r" + line.ljust(79))
+            self.stream.flush()
+        elif self.show and (now - self.logged >= LOG_INTERVAL or self.done.is_set()):
+            self.stream.write(line + "\n")
+            self.stream.flush()
+            self.logged = now
+        if self.series is not None:
+            self.series.write("{:.3f},{:.3f},{},{:.0f},{:.0f},{:.0f},{:.3f},{},{},{:.1f},{:.1f}\n".format(
+                now, now - self.start_time, workers, tasks, tiles, rays, busy, total_tiles, total_rays, rate, eta if np.isfinite(eta) else -1))
+            self.series.flush()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.poll()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop redrawing, after a last line with the final totals. Safe to call again."""
+        if self.done.is_set():
+            return
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.poll()
+        if self.show and self.tty:
+            self.stream.write("\n")
+        if self.series is not None:
+            self.series.close()
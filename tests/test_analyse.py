@@ -0,0 +1,21 @@
+import pytest
+
+import fluorotrace3
+
+# analyse needs tkinter and matplotlib
+analyse = pytest.importorskip("analyse")
+
+
+def test_runs_of_different_experiments_are_kept_apart(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    for zwalls, weighted in (((0, 0.1), False), ((0, 0.1), False), ((0, 0.2), False), ((0, 0.1), True)):
+        stage = fluorotrace3.get_stage(shape="rectangle", zwalls=zwalls)
+        fluorotrace3.add_raypoints(stage, num_raypoints=2, num_radials=16, seed=1)
+        fluorotrace3.trial_to_store(stage, step_size=0.01, engine="exact", histogram=False, use_progbar=False, weighted=weighted)
+    groups, overall = analyse.summarise_runs("./data", workers=1)
+    assert sorted(groups) == ["rectangle z=0-0.1 dl=0.01 random/fibonacci", "rectangle z=0-0.1 dl=0.01 random/fibonacci weighted",
+                              "rectangle z=0-0.2 dl=0.01 random/fibonacci"]
+    assert groups["rectangle z=0-0.1 dl=0.01 random/fibonacci"]["runs"] == 2
+    assert overall["ALL"]["runs"] == 3 and overall["ALL weighted"]["runs"] == 1
+    analyse.print_summaries(groups, overall)
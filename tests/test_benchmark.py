@@ -0,0 +1,21 @@
+import pytest
+
+import benchmark
+
+
+def test_pool_peak_rss_counts_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    single, pool = [dict(next(benchmark.workloads(shapes=["rectangle"], engines=["exact"], rays=[(20, 32)], workers=[w])))
+                    for w in (1, 2)]
+    single_rss = benchmark.measure(single)[-1]
+    pool_rss = benchmark.measure(pool)[-1]
+    # two forked workers, each at least as big as the process they were forked from
+    assert pool_rss > 1.5 * single_rss
+
+
+def test_failing_workload_raises(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # the scalar engine cannot trace arc edges
+    w = dict(next(benchmark.workloads(shapes=["semicircle_arc"], engines=["scalar"], rays=[(2, 8)], workers=[1])))
+    with pytest.raises(RuntimeError, match="scalar engine"):
+        benchmark.measure(w)
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+import distributed_fluorotrace3
+import parallel_fluorotrace3
+
+
+def test_failing_task_fails_the_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(distributed_fluorotrace3.TaskFailed, match="scalar engine"):
+        parallel_fluorotrace3.run_shapes(["semicircle_arc"], num_raypoints=4, num_radials=8, engine="scalar", workers=1, save=False,
+                                         seed=1, queue=str(tmp_path / "queue"), live=False)
+
+
+def test_dead_workers_fail_the_run(tmp_path, monkeypatch):
+    # workers forked after this die on their first task, without writing anything
+    monkeypatch.setattr(parallel_fluorotrace3, "run_task", lambda task: os._exit(1))
+    trial = dict(step_size=0.01, max_steps=100, engine="exact", batch_tiles=1, cull_escapes=True, keep_rays=True, weighted=False)
+    stages, tasks = parallel_fluorotrace3.make_tasks(["rectangle"], 4, 8, (0, 0.1), 2, trial, seed=1)
+    outputs, stop = distributed_fluorotrace3.publish(str(tmp_path / "queue"), tasks, workers=1, lease_timeout=1.0)
+    with pytest.raises(RuntimeError, match="died"):
+        list(outputs)
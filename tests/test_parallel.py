@@ -0,0 +1,36 @@
+import pytest
+
+import geometry
+import parallel_fluorotrace3
+
+
+def test_unknown_shape_raises():
+    with pytest.raises(geometry.UnknownShape):
+        geometry.get_shape("nope")
+
+
+def test_make_tasks_skips_only_unknown_shapes():
+    trial = dict(step_size=0.01, max_steps=100, engine="exact", batch_tiles=1, cull_escapes=True, keep_rays=True, weighted=False)
+    stages, tasks = parallel_fluorotrace3.make_tasks(["rectangle", "nope"], 4, 8, (0, 0.1), 2, trial, seed=1)
+    assert list(stages) == ["rectangle"]
+    assert len(tasks) == 2
+
+
+def test_resumed_chunks_have_their_times(tmp_path, monkeypatch):
+    import json
+    import store
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    path = parallel_fluorotrace3.run_shapes(["rectangle"], num_raypoints=8, num_radials=16, engine="exact", tiles_per_task=2, workers=1,
+                                            histogram=False, seed=1, live=False)["rectangle"]
+    # cut the run back to its first two chunks, as if it had been killed
+    with open(path + "/meta.json") as f:
+        meta = json.load(f)
+    meta["chunks"] = meta["chunks"][:2]
+    meta["rows"] = sum(c[2] for c in meta["chunks"])
+    meta["complete"] = False
+    store.write_json(path + "/meta.json", meta)
+    parallel_fluorotrace3.resume_runs([path], workers=1, live=False)
+    chunks = store.load_run(path)["meta"]["chunks"]
+    assert len(chunks) == 4
+    assert all(c[4][1] > 0 for c in chunks)
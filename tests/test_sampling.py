@@ -0,0 +1,41 @@
+import numpy as np
+
+import sampling
+
+
+def add_batches(conv, n, rays=100, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(n):
+        k = rng.binomial(rays, 0.2)
+        conv.add(np.column_stack([np.zeros(k), rng.random(k), np.zeros(k)]), rng.random(k), rays)
+
+
+def test_budget_alone_never_converges():
+    conv = sampling.Convergence({"max_rays":2000})
+    add_batches(conv, 10)
+    assert not conv.done()
+    assert not conv.report()["converged"]
+    add_batches(conv, 10)
+    report = conv.report()
+    assert report["budget_spent"] and not report["converged"]
+    assert conv.done()
+
+
+def test_accuracy_target_converges():
+    conv = sampling.Convergence({"efficiency":0.5, "max_rays":1e9})
+    add_batches(conv, 7)
+    assert not conv.done()
+    add_batches(conv, 1, seed=1)
+    assert conv.report()["converged"]
+
+
+def test_stratified_volume_samples_keep_their_strata():
+    import fluorotrace3
+    stage = fluorotrace3.get_stage(shape="angled", zwalls=(0, 0.1))
+    pts = sampling.volume_samples(256, stage, "stratified", seed=0)
+    c = stage["compiled"]
+    assert pts.shape == (256, 3)
+    assert sampling.tracer.points_in_polygon(pts[:, 0], pts[:, 1], c["start"], c["end"], c["grid"], c["arcs"]).all()
+    spread = {mode:np.array([sampling.volume_samples(256, stage, mode, seed=s)[:, :2].mean(axis=0) for s in range(60)]).std(axis=0)
+              for mode in ("random", "stratified")}
+    assert np.all(spread["stratified"] < 0.6 * spread["random"])
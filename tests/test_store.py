@@ -0,0 +1,32 @@
+import numpy as np
+
+import fluorotrace3
+import sampling
+import store
+
+
+def small_run(tmp_path, monkeypatch, **kwargs):
+    """A single process store run of 6 tiles in 3 chunks, returning its stage and run directory."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    stage = fluorotrace3.get_stage(shape="rectangle", zwalls=(0, 0.1))
+    fluorotrace3.add_raypoints(stage, num_raypoints=6, num_radials=32, seed=1)
+    path = fluorotrace3.trial_to_store(stage, step_size=0.01, engine="exact", batch_tiles=2, histogram=False, use_progbar=False, **kwargs)
+    return stage, path
+
+
+def test_chunk_rays_add_up(tmp_path, monkeypatch):
+    stage, path = small_run(tmp_path, monkeypatch)
+    meta = store.load_run(path)["meta"]
+    assert [c[3] for c in meta["chunks"]] == [2 * 32] * 3
+    assert sum(c[3] for c in meta["chunks"]) == meta["counts"]["rays"] == stage["counts"]["rays"]
+    assert np.isclose(sampling.run_errors(path)["efficiency"], meta["rows"] / meta["counts"]["rays"])
+
+
+def test_weighted_chunk_rays_add_up(tmp_path, monkeypatch):
+    stage, path = small_run(tmp_path, monkeypatch, weighted=True)
+    meta = store.load_run(path)["meta"]
+    assert sum(c[3] for c in meta["chunks"]) == meta["counts"]["rays"]
+    eff = sampling.run_errors(path)["efficiency"]
+    assert 0 < eff <= 1
+    assert np.isclose(eff, meta["counts"]["detected_weight"] / meta["counts"]["rays"])
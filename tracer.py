@@ -0,0 +1,983 @@
+#!/usr/bin/python3
+
+import io
+import hashlib
+
+import numpy as np
+
+import instrument
+
+EDGE_CODES = {"mirror":0, "detector":1, "dump":2}
+MIRROR, DETECTOR, DUMP = EDGE_CODES["mirror"], EDGE_CODES["detector"], EDGE_CODES["dump"]
+
+# below this many edges a brute force test over all edges beats the edge grid,
+# the walk the event tracer does through the grid only pays off much later
+GRID_MIN_EDGES = 256
+GRID_MIN_EDGES_EXACT = 4096
+
+# ray status codes, everything past DETECTED is a way of losing the ray
+ALIVE, DETECTED, MAX_STEPS, ESCAPED_Z, ESCAPED_SIDE, DUMPED, NO_INTERSECTION = range(7)
+STATUS_NAMES = ["alive", "detected", "max_steps", "escaped_z", "escaped_side", "dumped", "no_intersection"]
+
+# reflections do not use up steps, so a ray whose step is longer than the gap
+# between the z walls bounces forever without moving on; the step tracers give
+# up (as MAX_STEPS, counted as stuck) after this many path points per step
+MAX_PATH_FACTOR = 4
+
+# rays marched together by march_stream; finished rays are swapped for new
+# ones once this many slots, over REFILL_FRACTION of them, are free
+WAVEFRONT_WIDTH = 8192
+REFILL_FRACTION = 0.125
+
+# weighted rays (see fresnel_survivors) lighter than ROULETTE_WEIGHT play
+# Russian roulette: one in 1 / ROULETTE_SURVIVAL carries on, that much heavier
+ROULETTE_WEIGHT = 0.01
+ROULETTE_SURVIVAL = 0.1
+
+
+def compile_stage(stage):
+    """Compile the shapely stage from fluorotrace3.get_stage into flat arrays."""
+    keys = sorted(stage["edges"].keys())
+    edges = [stage["edges"][k] for k in keys]
+    return build_stage(stage["name"],
+                       [e["from"] for e in edges],
+                       [e["to"] for e in edges],
+                       [EDGE_CODES[e["type"]] for e in edges],
+                       stage["zwalls"],
+                       [e.get("bulge", 0) for e in edges])
+
+
+def build_stage(name, start, end, types, zwalls, bulge=None):
+    """
+    Compiled stage: contiguous (E, 2) edge start/end points, (E, 3) unit
+    normals, integer edge type codes, the z walls and the derived edge grid.
+    This is all the tracers need, and the only stage form that is shipped
+    to workers or saved. Edges with a non zero bulge (see
+    geometry.get_shape) are circular arcs, described by "arcs" (see
+    build_arcs); their normals here are those of their chords. Stages with
+    arcs have no edge grid.
+    """
+    start = np.ascontiguousarray(start, dtype=float)
+    end = np.ascontiguousarray(end, dtype=float)
+    bulge = np.zeros(len(start)) if bulge is None else np.ascontiguousarray(bulge, dtype=float)
+    d = end - start
+    normal = np.stack([d[:, 1], -d[:, 0], np.zeros(len(d))], axis=1)
+    normal /= np.linalg.norm(normal, axis=1)[:, None]
+    arcs = build_arcs(start, end, bulge)
+    cstage = {"name":name,
+              "start":start,
+              "end":end,
+              "normal":normal,
+              "type":np.ascontiguousarray(types, dtype=np.int8),
+              "zwalls":np.array(zwalls, dtype=float),
+              "bulge":bulge,
+              "arcs":arcs,
+              "grid":build_edge_grid(start, end) if arcs is None else None}
+    cstage["hash"] = stage_hash(cstage)
+    return cstage
+
+
+def build_arcs(start, end, bulge):
+    """
+    Circle of each arc edge: its index in "edge", "centre", "radius", and
+    "sign", +1 if it runs counterclockwise round the centre. None if every
+    edge is straight.
+    """
+    edge = np.flatnonzero(bulge)
+    if not len(edge):
+        return None
+    a, b, k = start[edge], end[edge], bulge[edge]
+    chord = b - a
+    length = np.linalg.norm(chord, axis=1)
+    left = np.stack([-chord[:, 1], chord[:, 0]], axis=1) / length[:, None]
+    radius = length * (1 + k * k) / (4 * np.abs(k))
+    sagitta = np.abs(k) * length / 2
+    centre = (a + b) / 2 + (np.sign(k) * (radius - sagitta))[:, None] * left
+    index = np.full(len(start), -1)
+    index[edge] = np.arange(len(edge))
+    return {"edge":edge, "index":index, "centre":centre, "radius":radius, "sign":np.sign(k)}
+
+
+def on_arcs(q, start, end, arcs, which=None):
+    """
+    Whether points q of the circles of arcs (all, or those numbered which
+    for each point) lie on the arc: a chord splits its circle in two, and
+    the arc is the part on the side it bulges to.
+    """
+    e = arcs["edge"] if which is None else arcs["edge"][which]
+    sign = arcs["sign"] if which is None else arcs["sign"][which]
+    a, chord = start[e], end[e] - start[e]
+    cross = chord[..., 0] * (q[..., 1] - a[..., 1]) - chord[..., 1] * (q[..., 0] - a[..., 0])
+    return sign * cross <= 1e-12 * np.sum(chord * chord, axis=-1)
+
+
+def circle_roots(p, r, centre, radius):
+    """
+    Both parameters t (smaller first) at which the lines p + t r meet the
+    circles, broadcasting over leading axes; nan where they miss.
+    """
+    f = p - centre
+    a = np.sum(r * r, axis=-1)
+    b = 2 * np.sum(f * r, axis=-1)
+    c = np.sum(f * f, axis=-1) - radius ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sq = np.sqrt(b * b - 4 * a * c)
+        return (-b - sq) / (2 * a), (-b + sq) / (2 * a)
+
+
+def arc_params(p, r, start, end, arcs):
+    """
+    circle_roots of the lines p + t r ((N, 2) each) with the circle of every
+    arc, (N, A) each, with nan for the points that are not on the arc.
+    """
+    roots = []
+    for t in circle_roots(p[:, None, :], r[:, None, :], arcs["centre"][None], arcs["radius"][None]):
+        q = p[:, None, :] + t[..., None] * r[:, None, :]
+        roots.append(np.where(on_arcs(q, start, end, arcs), t, np.nan))
+    return roots
+
+
+def arc_crossings(p0, p1, edge, cstage):
+    """Where each segment p0 -> p1 first meets its edge, if that is an arc (else p1)."""
+    arcs, q = cstage["arcs"], p1.copy()
+    sel = np.flatnonzero(arcs["index"][edge] >= 0)
+    k = arcs["index"][edge[sel]]
+    a, b = p0[sel, :2], p1[sel, :2]
+    t = np.full(len(sel), np.nan)
+    for root in circle_roots(a, b - a, arcs["centre"][k], arcs["radius"][k]):
+        on = on_arcs(a + root[:, None] * (b - a), cstage["start"], cstage["end"], arcs, k)
+        t = np.where(np.isnan(t) & on & (root >= 0) & (root <= 1), root, t)
+    q[sel] = p0[sel] + np.where(np.isnan(t), 1, t)[:, None] * (p1[sel] - p0[sel])
+    return q
+
+
+def wall_normals(cstage, edge, q):
+    """Unit normals of edges at the points q on them: the chord normal, or the radius for arcs."""
+    wall = cstage["normal"][edge]
+    arcs = cstage["arcs"]
+    if arcs is None:
+        return wall
+    wall = wall.copy()
+    a = arcs["index"][edge]
+    sel = np.flatnonzero(a >= 0)
+    v = q[sel, :2] - arcs["centre"][a[sel]]
+    wall[sel, :2] = arcs["sign"][a[sel], None] * v / np.linalg.norm(v, axis=1)[:, None]
+    return wall
+
+
+def stage_bounds(cstage):
+    """Corners (lo, hi) of the box round the outline, arcs included."""
+    pts = [cstage["start"], cstage["end"]]
+    arcs = cstage["arcs"]
+    if arcs is not None:
+        # the points of each circle furthest along x and y, where they are on the arc
+        for off in ([1, 0], [-1, 0], [0, 1], [0, -1]):
+            q = arcs["centre"] + arcs["radius"][:, None] * np.array(off, dtype=float)
+            pts.append(q[on_arcs(q, cstage["start"], cstage["end"], arcs)])
+    pts = np.concatenate(pts)
+    return pts.min(axis=0), pts.max(axis=0)
+
+
+def edge_points(cstage, i, per_arc=64):
+    """Points along edge i from its start to its end, per_arc + 1 of them for an arc."""
+    a, b, arcs = cstage["start"][i], cstage["end"][i], cstage["arcs"]
+    k = -1 if arcs is None else arcs["index"][i]
+    if k < 0:
+        return np.stack([a, b])
+    c = arcs["centre"][k]
+    phi = np.arctan2(a[1] - c[1], a[0] - c[0]) + 4 * np.arctan(cstage["bulge"][i]) * np.arange(per_arc + 1) / per_arc
+    return c + arcs["radius"][k] * np.stack([np.cos(phi), np.sin(phi)], axis=1)
+
+
+def outline(cstage, per_arc=64):
+    """Closed polyline of the outline, for plotting and shapely, with each arc drawn as per_arc segments."""
+    return np.concatenate([edge_points(cstage, i, per_arc)[:-1] for i in range(len(cstage["start"]))] + [cstage["start"][:1]])
+
+
+def stage_hash(cstage):
+    """sha256 of the geometry of a compiled stage, independent of its name and grid."""
+    h = hashlib.sha256()
+    # straight edge stages hash as they did before arcs
+    keys = ("start", "end", "type", "zwalls") + (("bulge",) if cstage.get("arcs") is not None else ())
+    for key in keys:
+        arr = np.ascontiguousarray(cstage[key])
+        h.update(key.encode())
+        h.update(str(arr.dtype).encode() + str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def pack_stage(cstage):
+    """Serialise a compiled stage to npz bytes, leaving out everything derived."""
+    buf = io.BytesIO()
+    np.savez(buf, name=np.array(cstage["name"]), start=cstage["start"], end=cstage["end"],
+             type=cstage["type"], zwalls=cstage["zwalls"], bulge=cstage["bulge"])
+    return buf.getvalue()
+
+
+def unpack_stage(data):
+    with np.load(io.BytesIO(data)) as f:
+        bulge = f["bulge"] if "bulge" in f.files else None
+        return build_stage(str(f["name"]), f["start"], f["end"], f["type"], f["zwalls"], bulge)
+
+
+def get_compiled(stage):
+    """Compiled form of either kind of stage."""
+    if "normal" in stage:
+        return stage
+    if "compiled" in stage:
+        return stage["compiled"]
+    return compile_stage(stage)
+
+
+def segment_hits_box(a, b, lo, hi):
+    """Liang-Barsky clip of the segment a -> b against the box lo, hi."""
+    t0, t1 = 0.0, 1.0
+    d = b - a
+    for k in range(2):
+        if d[k] == 0:
+            if a[k] < lo[k] or a[k] > hi[k]:
+                return False
+            continue
+        ta, tb = (lo[k] - a[k]) / d[k], (hi[k] - a[k]) / d[k]
+        t0, t1 = max(t0, min(ta, tb)), min(t1, max(ta, tb))
+        if t0 > t1:
+            return False
+    return True
+
+
+def build_edge_grid(start, end, edges_per_cell=0.5):
+    """
+    Uniform grid over the stage outline. Each cell lists (in ascending order,
+    padded with -1) the edges that pass through it, and records whether its
+    centre is inside the polygon, so that both point-in-polygon and edge
+    lookups only need the handful of edges local to a point.
+    """
+    lo = np.minimum(start.min(axis=0), end.min(axis=0))
+    hi = np.maximum(start.max(axis=0), end.max(axis=0))
+    span = hi - lo
+    pad = 1e-6 * max(span.max(), 1)
+    lo, hi = lo - pad, hi + pad
+    span = hi - lo
+    cell = np.sqrt(span[0] * span[1] * edges_per_cell / len(start))
+    shape = np.maximum(np.ceil(span / cell), 1).astype(int)
+
+    lists = [[] for _ in range(shape[0] * shape[1])]
+    margin = 1e-9 * cell
+    for i, (a, b) in enumerate(zip(start, end)):
+        ix0, iy0 = np.clip(((np.minimum(a, b) - lo) // cell).astype(int), 0, shape - 1)
+        ix1, iy1 = np.clip(((np.maximum(a, b) - lo) // cell).astype(int), 0, shape - 1)
+        for ix in range(ix0, ix1 + 1):
+            for iy in range(iy0, iy1 + 1):
+                clo = lo + cell * np.array([ix, iy])
+                if segment_hits_box(a, b, clo - margin, clo + cell + margin):
+                    lists[ix * shape[1] + iy].append(i)
+
+    width = max(1, max(len(l) for l in lists))
+    cell_edges = np.full((len(lists), width), -1, dtype=np.int32)
+    for c, l in enumerate(lists):
+        cell_edges[c, :len(l)] = l
+
+    ix, iy = np.divmod(np.arange(len(lists)), shape[1])
+    centres = lo + cell * (np.stack([ix, iy], axis=1) + 0.5)
+    inside = points_in_polygon(centres[:, 0], centres[:, 1], start, end)
+
+    # chebyshev distance (in cells) from each cell to the nearest cell with edges
+    occupied = (cell_edges[:, 0] >= 0).reshape(shape)
+    empty = np.full(shape, shape.max(), dtype=np.int32)
+    empty[occupied] = 0
+    r = 0
+    while not occupied.all():
+        r += 1
+        grown = np.pad(occupied, 1)
+        grown = np.max([grown[1+i:1+i+shape[0], 1+j:1+j+shape[1]] for i in (-1, 0, 1) for j in (-1, 0, 1)], axis=0)
+        empty[grown & ~occupied] = r
+        occupied = grown
+    return {"origin":lo, "cell":cell, "shape":shape, "edges":cell_edges, "inside":inside,
+            "empty":empty.ravel()}
+
+
+def grid_cells(grid, x, y):
+    """Cell (ix, iy) of each point, clipped onto the grid."""
+    ix = np.clip(((x - grid["origin"][0]) // grid["cell"]).astype(int), 0, grid["shape"][0] - 1)
+    iy = np.clip(((y - grid["origin"][1]) // grid["cell"]).astype(int), 0, grid["shape"][1] - 1)
+    return ix, iy
+
+
+def grid_segment_edges(grid, p0, p1):
+    """Sorted edge indices from every cell under the bounding box of the segment p0 -> p1."""
+    ix0, iy0 = grid_cells(grid, np.array([min(p0[0], p1[0])]), np.array([min(p0[1], p1[1])]))
+    ix1, iy1 = grid_cells(grid, np.array([max(p0[0], p1[0])]), np.array([max(p0[1], p1[1])]))
+    ny = grid["shape"][1]
+    cells = [ix * ny + iy for ix in range(ix0[0], ix1[0] + 1) for iy in range(iy0[0], iy1[0] + 1)]
+    found = grid["edges"][cells].ravel()
+    return np.unique(found[found >= 0])
+
+
+def segment_params(p, r, a, s):
+    """Parameters (t, u) of the crossing of p + t r with a + u s, nan/inf when parallel."""
+    qp = a - p
+    denom = r[..., 0] * s[..., 1] - r[..., 1] * s[..., 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (qp[..., 0] * s[..., 1] - qp[..., 1] * s[..., 0]) / denom
+        u = (qp[..., 0] * r[..., 1] - qp[..., 1] * r[..., 0]) / denom
+    return t, u, denom != 0
+
+
+def points_in_polygon(x, y, start, end, grid=None, arcs=None):
+    """
+    Even-odd test of the points (x, y) against the closed outline start[i] ->
+    end[i]. With arcs, the test is against the chords and then flipped for
+    each circular segment (between an arc and its chord) a point is in.
+    """
+    if grid is not None:
+        return grid_points_in_polygon(grid, x, y, start, end)
+    x, y = x[:, None], y[:, None]
+    x0, y0 = start[None, :, 0], start[None, :, 1]
+    x1, y1 = end[None, :, 0], end[None, :, 1]
+    straddle = (y0 > y) != (y1 > y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xcross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    flips = np.count_nonzero(straddle & (x < xcross), axis=1)
+    if arcs is not None:
+        q = np.stack([x, y], axis=2)
+        incircle = np.sum((q - arcs["centre"][None]) ** 2, axis=2) < arcs["radius"][None] ** 2
+        flips = flips + np.count_nonzero(incircle & on_arcs(q, start, end, arcs), axis=1)
+    return (flips % 2) == 1
+
+
+def grid_points_in_polygon(grid, x, y, start, end):
+    """
+    Point-in-polygon through the edge grid: start from the known state of the
+    cell centre and flip it for every cell edge crossed on the way to the point.
+    """
+    lo, cell, shape = grid["origin"], grid["cell"], grid["shape"]
+    ongrid = (x >= lo[0]) & (y >= lo[1]) & (x < lo[0] + cell * shape[0]) & (y < lo[1] + cell * shape[1])
+    ix, iy = grid_cells(grid, x, y)
+    c = ix * shape[1] + iy
+    centre = lo + cell * (np.stack([ix, iy], axis=1) + 0.5)
+    cand = grid["edges"][c]
+    a, b = start[cand], end[cand]
+    pts = np.stack([x, y], axis=1)
+    t, u, ok = segment_params(centre[:, None, :], (pts - centre)[:, None, :], a, b - a)
+    # half open on the edge so a shared vertex only counts once
+    crossed = ok & (cand >= 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u < 1)
+    return ongrid & (grid["inside"][c] ^ (np.count_nonzero(crossed, axis=1) % 2 == 1))
+
+
+def first_crossed_edge(p0, p1, start, end, grid=None, stats=None, arcs=None):
+    """Index of the lowest numbered edge crossed by each segment p0 -> p1, or -1."""
+    if grid is not None:
+        return grid_first_crossed_edge(grid, p0, p1, start, end, stats)
+    instrument.add(stats, edge_tests=len(p0) * len(start))
+    r = (p1 - p0)[:, None, :]
+    s = (end - start)[None, :, :]
+    qp = start[None, :, :] - p0[:, None, :]
+    denom = r[..., 0] * s[..., 1] - r[..., 1] * s[..., 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (qp[..., 0] * s[..., 1] - qp[..., 1] * s[..., 0]) / denom
+        u = (qp[..., 0] * r[..., 1] - qp[..., 1] * r[..., 0]) / denom
+    hit = (denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    if arcs is not None:
+        # arc edges are crossed where the segment meets their arc, not their chord
+        t1, t2 = arc_params(p0, p1 - p0, start, end, arcs)
+        hit[:, arcs["edge"]] = ((t1 >= 0) & (t1 <= 1)) | ((t2 >= 0) & (t2 <= 1))
+    return np.where(hit.any(axis=1), hit.argmax(axis=1), -1)
+
+
+def grid_first_crossed_edge(grid, p0, p1, start, end, stats=None):
+    """
+    first_crossed_edge using only the edges of the (at most 2 x 2) cells under
+    each short segment. Segments spanning more cells fall back to all edges.
+    """
+    ny = grid["shape"][1]
+    ix0, iy0 = grid_cells(grid, np.minimum(p0[:, 0], p1[:, 0]), np.minimum(p0[:, 1], p1[:, 1]))
+    ix1, iy1 = grid_cells(grid, np.maximum(p0[:, 0], p1[:, 0]), np.maximum(p0[:, 1], p1[:, 1]))
+    short = (ix1 - ix0 <= 1) & (iy1 - iy0 <= 1)
+
+    edge = np.full(len(p0), -1)
+    sel = np.flatnonzero(short)
+    cells = np.stack([ix0[sel] * ny + iy0[sel], ix0[sel] * ny + iy1[sel],
+                      ix1[sel] * ny + iy0[sel], ix1[sel] * ny + iy1[sel]], axis=1)
+    cand = grid["edges"][cells].reshape(len(sel), 4 * grid["edges"].shape[1])
+    instrument.add(stats, edge_tests=np.count_nonzero(cand >= 0))
+    a, b = start[cand], end[cand]
+    t, u, ok = segment_params(p0[sel, None, :], (p1 - p0)[sel, None, :], a, b - a)
+    hit = ok & (cand >= 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    lowest = np.where(hit, cand, len(start)).min(axis=1)
+    edge[sel] = np.where(lowest < len(start), lowest, -1)
+
+    sel = np.flatnonzero(~short)
+    if len(sel):
+        edge[sel] = first_crossed_edge(p0[sel], p1[sel], start, end, stats=stats)
+    return edge
+
+
+def normalise_rows(v):
+    return v / np.linalg.norm(v, axis=-1)[..., None]
+
+
+def reflect_rays(dirs, norms):
+    dirs = normalise_rows(dirs)
+    return normalise_rows(np.sum(dirs * norms, axis=1)[:, None] * -2 * norms + dirs)
+
+
+def outside_crit_angle(dirs, norms, crit_angle):
+    """Vector form of fluorotrace3.is_outside_crit_angle, norms must be unit length."""
+    cosang = np.sum(normalise_rows(dirs) * norms, axis=1)
+    angle = np.abs(np.arccos(np.clip(cosang, -1, 1))) - np.pi/2
+    return angle > crit_angle
+
+
+def fresnel_reflectance(dirs, norms, n1, n2):
+    """
+    Unpolarised Fresnel reflectance of rays dirs meeting walls with unit
+    normals norms (either way round), going from index n1 into n2; 1 past
+    the critical angle.
+    """
+    cosi = np.abs(np.sum(normalise_rows(dirs) * norms, axis=1))
+    sint2 = (n1 / n2) ** 2 * (1 - cosi * cosi)
+    cost = np.sqrt(np.clip(1 - sint2, 0, 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rs = ((n1 * cosi - n2 * cost) / (n1 * cosi + n2 * cost)) ** 2
+        rp = ((n1 * cost - n2 * cosi) / (n1 * cost + n2 * cosi)) ** 2
+    return np.where(sint2 >= 1, 1.0, (rs + rp) / 2)
+
+
+def mix64(x):
+    """splitmix64 finaliser of the uint64 array x (wrapping, as numpy arrays do)."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def ray_keys(pos, dirs):
+    """
+    A 64 bit key for each ray, hashed from the bits of its launch position
+    and direction, so its roulette draws are its own whichever batch or
+    wavefront it is traced in.
+    """
+    bits = np.ascontiguousarray(np.concatenate([pos, dirs], axis=1), dtype=float).view(np.uint64)
+    key = np.zeros(len(pos), dtype=np.uint64)
+    for i in range(bits.shape[1]):
+        key = mix64(key ^ bits[:, i])
+    return key
+
+
+def ray_draws(key, events):
+    """Uniform [0, 1) draw for each ray's events-th wall, from its key."""
+    x = mix64(key + events.astype(np.uint64) * np.uint64(0x9e3779b97f4a7c15))
+    return (x >> np.uint64(11)).astype(float) * 2.0 ** -53
+
+
+def fresnel_survivors(dirs, norms, fresnel, weight, keys, events, sel):
+    """
+    Weighted ray form of outside_crit_angle for the rays sel (meeting walls
+    with normals norms): rather than escaping, every ray reflects with its
+    weight scaled by the Fresnel reflectance for the indices fresnel, (n1,
+    n2). Rays left lighter than ROULETTE_WEIGHT play Russian roulette.
+    Returns which of sel carry on; the weight of the others is zeroed.
+    """
+    weight[sel] *= fresnel_reflectance(dirs, norms, *fresnel)
+    light = weight[sel] < ROULETTE_WEIGHT
+    live = ~light | (ray_draws(keys[sel], events[sel]) < ROULETTE_SURVIVAL)
+    weight[sel[light & live]] /= ROULETTE_SURVIVAL
+    weight[sel[~live]] = 0
+    return live
+
+
+def segment_distances(pts, start, end):
+    """(N, E) distances from the 2D points pts to the segments start[i] -> end[i]."""
+    s = end - start
+    u = np.sum((pts[:, None, :] - start[None]) * s[None], axis=2) / np.sum(s * s, axis=1)[None]
+    closest = start[None] + np.clip(u, 0, 1)[..., None] * s[None]
+    return np.linalg.norm(pts[:, None, :] - closest, axis=2)
+
+
+def edge_point_distances(pts, cstage, edges):
+    """segment_distances to the edges numbered edges of a compiled stage, to the arc itself for arc edges."""
+    start, end, arcs = cstage["start"], cstage["end"], cstage["arcs"]
+    dist = segment_distances(pts, start[edges], end[edges])
+    if arcs is None:
+        return dist
+    for j in np.flatnonzero(arcs["index"][edges] >= 0):
+        k = arcs["index"][edges[j]]
+        v = pts - arcs["centre"][k]
+        r = np.linalg.norm(v, axis=1)
+        # the nearest point of the circle, if it is on the arc, else the nearer end
+        q = arcs["centre"][k] + arcs["radius"][k] * v / np.where(r > 0, r, 1)[:, None]
+        ends = np.minimum(np.linalg.norm(pts - start[edges[j]], axis=1), np.linalg.norm(pts - end[edges[j]], axis=1))
+        on = on_arcs(q, start, end, arcs, np.full(len(pts), k))
+        dist[:, j] = np.where(on, np.abs(r - arcs["radius"][k]), ends)
+    return dist
+
+
+def escape_cone_culled(pos, dirs, stage, crit_angle=np.pi/2, margin=0):
+    """
+    Rays that are bound to escape through a z wall before they can reach a
+    detector. The side walls are vertical, so reflections off them never
+    change |dz|: a ray inside the z wall escape cone escapes at its first z
+    wall, after an in-plane distance no reflection can stretch. If that is
+    shorter than the distance to the nearest detector edge the ray can never
+    be detected. margin is extra path length allowed before the z wall
+    (one step for the marching tracers).
+    """
+    cstage = get_compiled(stage)
+    minz, maxz = cstage["zwalls"]
+    dirs = normalise_rows(np.asarray(dirs, dtype=float))
+    dz = np.abs(dirs[:, 2])
+    escapes = np.arcsin(np.clip(dz, 0, 1)) <= crit_angle
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tz = np.where(dirs[:, 2] > 0, maxz - pos[:, 2], pos[:, 2] - minz) / dz
+    reach = (tz + margin) * np.sqrt(np.clip(1 - dz * dz, 0, 1))
+    detector = np.flatnonzero(cstage["type"] == DETECTOR)
+    if not len(detector):
+        return escapes & (dz > 0)
+    nearest = edge_point_distances(np.asarray(pos, dtype=float)[:, :2], cstage, detector).min(axis=1)
+    return escapes & (dz > 0) & (reach < nearest)
+
+
+def march_rays(pos, dirs, stage, dl=0.1, max_steps=10000, crit_angle=np.pi/2, stats=None, fresnel=None):
+    """
+    Batch version of fluorotrace3.sim_ray: march every ray in pos/dirs (both
+    (N, 3)) forward in steps of dl, reflecting and terminating them together.
+    Only the last three path points of each ray are kept, which is all
+    run_trial needs. Counters go to stats (see instrument.new_stats) if given.
+    With fresnel, (n1, n2), rays are weighted rather than escaping at the
+    mirror and z walls (see fresnel_survivors); the result's "weight" is
+    otherwise 1.
+    """
+    for _, res in march_stream([(None, pos, dirs)], stage, dl, max_steps, crit_angle, width=max(len(pos), 1), stats=stats, fresnel=fresnel):
+        return res
+
+
+def march_stream(batches, stage, dl=0.1, max_steps=10000, crit_angle=np.pi/2, width=WAVEFRONT_WIDTH, stats=None, fresnel=None):
+    """
+    march_rays over a stream of batches of rays, (key, pos, dirs) each,
+    yielding (key, result) for each batch as soon as all its rays have
+    finished, with the result march_rays would give for the batch alone.
+    Batches can finish out of order. The rays of every batch are marched
+    together in a wavefront of about width rays: finished rays are taken out
+    and their slots refilled from the following batches, so the long tail of
+    one batch's slowest rays is marched alongside the next batches rather
+    than a few at a time. Batches are only read as slots free up.
+    """
+    cstage = get_compiled(stage)
+    start, end, types, arcs = cstage["start"], cstage["end"], cstage["type"], cstage["arcs"]
+    minz, maxz = cstage["zwalls"]
+    grid = cstage["grid"] if len(start) >= GRID_MIN_EDGES else None
+    limit = MAX_PATH_FACTOR * (max_steps + 1)
+
+    # the wavefront, one row per ray, and the batch and row within it each ray came from
+    pos, dirs = np.zeros((0, 3)), np.zeros((0, 3))
+    status = np.zeros(0, dtype=np.int8)
+    itercount, pathlen, bounces = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    last = np.zeros((0, 3, 3))  # path[-1], path[-2], path[-3]
+    weight, keys = np.zeros(0), np.zeros(0, dtype=np.uint64)
+    owner, row = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # batches read but not yielded yet, by number, and the rest of the one being read
+    outs, left = {}, {}
+    source, reading = iter(batches), None
+    number = 0
+    contains, reflect_z, stuck = 0, 0, 0
+    reflect_edge = np.zeros(len(start), dtype=np.int64)
+
+    def finished(b):
+        out = outs.pop(b)
+        del left[b]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            enddir = normalise_rows(out["end"] - out["prev2"])
+        return out["key"], {"status":out["status"],
+                            "detected":out["status"] == DETECTED,
+                            "end":out["end"],
+                            "enddir":enddir,
+                            "opl":out["itercount"] * dl,
+                            "bounces":out["bounces"],
+                            "pathlen":out["pathlen"],
+                            "weight":out["weight"]}
+
+    while True:
+        ## refill the free slots from the batches
+        free = width - len(pos)
+        if source is not None and (free >= REFILL_FRACTION * width or not len(pos)):
+            new = []
+            while free > 0:
+                if reading is None:
+                    try:
+                        key, bpos, bdirs = next(source)
+                    except StopIteration:
+                        source = None
+                        break
+                    n = len(bpos)
+                    reading = [number, np.array(bpos, dtype=float).reshape(n, 3), normalise_rows(np.array(bdirs, dtype=float).reshape(n, 3)), 0]
+                    outs[number] = {"key":key, "status":np.full(n, ALIVE, dtype=np.int8), "end":np.zeros((n, 3)), "prev2":np.zeros((n, 3)),
+                                    "itercount":np.zeros(n, dtype=np.int64), "pathlen":np.zeros(n, dtype=np.int64), "bounces":np.zeros(n, dtype=np.int64),
+                                    "weight":np.ones(n)}
+                    left[number] = n
+                    number += 1
+                b, bpos, bdirs, k = reading
+                take = min(free, len(bpos) - k)
+                new.append((b, bpos[k:k + take], bdirs[k:k + take], np.arange(k, k + take)))
+                free -= take
+                reading[3] += take
+                if reading[3] == len(bpos):
+                    reading = None
+            if new:
+                m = sum(len(r) for _, _, _, r in new)
+                pos = np.concatenate([pos] + [p for _, p, _, _ in new])
+                dirs = np.concatenate([dirs] + [d for _, _, d, _ in new])
+                status = np.concatenate([status, np.full(m, ALIVE, dtype=np.int8)])
+                itercount = np.concatenate([itercount, np.zeros(m, dtype=np.int64)])
+                pathlen = np.concatenate([pathlen, np.zeros(m, dtype=np.int64)])
+                bounces = np.concatenate([bounces, np.zeros(m, dtype=np.int64)])
+                last = np.concatenate([last, np.zeros((m, 3, 3))])
+                weight = np.concatenate([weight, np.ones(m)])
+                keys = np.concatenate([keys] + [ray_keys(p, d) for _, p, d, _ in new])
+                owner = np.concatenate([owner] + [np.full(len(r), b) for b, _, _, r in new])
+                row = np.concatenate([row] + [r for _, _, _, r in new])
+            # batches with no rays are finished as soon as they are read
+            for b in [b for b, n in left.items() if n == 0]:
+                yield finished(b)
+
+        ## take out rays that have finished or used up their steps
+        stuck += np.count_nonzero(pathlen > limit)
+        status[(status == ALIVE) & ((itercount > max_steps) | (pathlen > limit))] = MAX_STEPS
+        done = status != ALIVE
+        if np.any(done):
+            for b in np.unique(owner[done]):
+                sel = np.flatnonzero(done & (owner == b))
+                out, r = outs[b], row[sel]
+                out["status"][r], out["end"][r], out["prev2"][r] = status[sel], last[sel, 0], last[sel, 2]
+                out["itercount"][r], out["pathlen"][r], out["bounces"][r] = itercount[sel], pathlen[sel], bounces[sel]
+                out["weight"][r] = weight[sel]
+                left[b] -= len(sel)
+            keep = ~done
+            pos, dirs, status, itercount, pathlen, bounces, last, weight, keys, owner, row = (
+                pos[keep], dirs[keep], status[keep], itercount[keep], pathlen[keep], bounces[keep], last[keep], weight[keep], keys[keep],
+                owner[keep], row[keep])
+            finished_batches = [b for b in list(left) if left[b] == 0]
+            if finished_batches:
+                instrument.add(stats, reflect_edge=reflect_edge, contains=contains, reflect_z=reflect_z, stuck=stuck)
+                contains, reflect_z, stuck = 0, 0, 0
+                reflect_edge[:] = 0
+                for b in finished_batches:
+                    yield finished(b)
+        if not len(pos):
+            if source is None:
+                break
+            continue
+
+        ## one step of every ray
+        itercount += 1
+        last[:, 1:] = last[:, :-1]
+        last[:, 0] = pos
+        pathlen += 1
+        newpos = pos + dirs * dl
+
+        ## side walls
+        inside = points_in_polygon(newpos[:, 0], newpos[:, 1], start, end, grid, arcs)
+        contains += len(pos)
+        out = np.flatnonzero(~inside)
+        if len(out):
+            edge = first_crossed_edge(newpos[out, :2], pos[out, :2], start, end, grid, stats, arcs)
+            status[out[edge < 0]] = NO_INTERSECTION
+            etype = types[edge]
+            status[out[(edge >= 0) & (etype == DETECTOR)]] = DETECTED
+            status[out[(edge >= 0) & (etype == DUMP)]] = DUMPED
+
+            mirror = np.flatnonzero((edge >= 0) & (etype == MIRROR))
+            sel = out[mirror]
+            hit = None if arcs is None else arc_crossings(pos[sel, :2], newpos[sel, :2], edge[mirror], cstage)
+            wall = wall_normals(cstage, edge[mirror], hit)
+            if fresnel is None:
+                tir = outside_crit_angle(dirs[sel], wall, crit_angle)
+            else:
+                tir = fresnel_survivors(dirs[sel], wall, fresnel, weight, keys, bounces, sel)
+            status[sel[~tir]] = ESCAPED_SIDE
+            np.add.at(reflect_edge, edge[mirror[tir]], 1)
+            sel, wall = sel[tir], wall[tir]
+            itercount[sel] -= 1
+            bounces[sel] += 1
+            newpos[sel] = newpos[sel] - dirs[sel] * dl
+            dirs[sel] = reflect_rays(dirs[sel], wall)
+
+        ## z walls
+        for zsel, wall in ((newpos[:, 2] < minz, [0, 0, 1]), (newpos[:, 2] > maxz, [0, 0, -1])):
+            sel = np.flatnonzero(zsel & (status == ALIVE))
+            if not len(sel):
+                continue
+            wall = np.tile(wall, (len(sel), 1)).astype(float)
+            if fresnel is None:
+                tir = outside_crit_angle(dirs[sel], wall, crit_angle)
+            else:
+                tir = fresnel_survivors(dirs[sel], wall, fresnel, weight, keys, bounces, sel)
+            status[sel[~tir]] = ESCAPED_Z
+            sel, wall = sel[tir], wall[tir]
+            reflect_z += len(sel)
+            itercount[sel] -= 1
+            bounces[sel] += 1
+            newpos[sel] = newpos[sel] - dirs[sel] * dl
+            dirs[sel] = reflect_rays(dirs[sel], wall)
+
+        pos = newpos
+
+
+def edge_distances(pos, dirs, start, end, skip=None, grid=None, stats=None, arcs=None):
+    """
+    Path length along each ray (pos, dirs are (N, 3), dirs unit length) to the
+    nearest side wall, and the index of that wall. Rays that never reach a
+    wall get inf and -1. skip holds, per ray, an edge to ignore (the one it
+    has just reflected off) or -1. A ray can meet an arc it has just
+    reflected off again, so for those only the root at the ray's start is
+    ignored.
+    """
+    if grid is not None:
+        return grid_edge_distances(grid, pos, dirs, start, end, skip, stats)
+    instrument.add(stats, edge_tests=len(pos) * len(start))
+    p, d = pos[:, None, :2], dirs[:, None, :2]
+    s = (end - start)[None, :, :]
+    qp = start[None, :, :] - p
+    denom = d[..., 0] * s[..., 1] - d[..., 1] * s[..., 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (qp[..., 0] * s[..., 1] - qp[..., 1] * s[..., 0]) / denom
+        u = (qp[..., 0] * d[..., 1] - qp[..., 1] * d[..., 0]) / denom
+    hit = (denom != 0) & (t > 0) & (u >= 0) & (u <= 1)
+    if skip is not None:
+        hit[np.arange(len(pos)), skip] &= skip < 0
+    t = np.where(hit, t, np.inf)
+    if arcs is not None:
+        t1, t2 = arc_params(pos[:, :2], dirs[:, :2], start, end, arcs)
+        if skip is not None:
+            # the root nearest the ray's start is the point it reflected at
+            on = arcs["edge"][None] == skip[:, None]
+            near = np.abs(np.nan_to_num(t1, nan=np.inf)) <= np.abs(np.nan_to_num(t2, nan=np.inf))
+            t1 = np.where(on & near, np.nan, t1)
+            t2 = np.where(on & ~near, np.nan, t2)
+        t[:, arcs["edge"]] = np.fmin(np.where(t1 > 0, t1, np.nan), np.where(t2 > 0, t2, np.nan))
+        t[np.isnan(t)] = np.inf
+    edge = np.argmin(t, axis=1)
+    dist = t[np.arange(len(pos)), edge]
+    return dist, np.where(np.isfinite(dist), edge, -1)
+
+
+def grid_edge_distances(grid, pos, dirs, start, end, skip=None, stats=None):
+    """
+    edge_distances by walking each ray through the edge grid one cell at a
+    time (2D DDA), only testing the edges listed in the cells it crosses.
+    Runs of empty cells are jumped over using the grid's "empty" distances.
+    """
+    lo, cell, shape = grid["origin"], grid["cell"], grid["shape"]
+    n = len(pos)
+    p, d = pos[:, :2], dirs[:, :2]
+    if skip is None:
+        skip = np.full(n, -1)
+    stepx, stepy = np.where(d[:, 0] > 0, 1, -1), np.where(d[:, 1] > 0, 1, -1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tdeltax = np.where(d[:, 0] != 0, cell / np.abs(d[:, 0]), np.inf)
+        tdeltay = np.where(d[:, 1] != 0, cell / np.abs(d[:, 1]), np.inf)
+
+    def restart(sel, t0):
+        # (re)start the walk of rays sel from path length t0
+        q = p[sel] + d[sel] * t0[:, None]
+        ix[sel], iy[sel] = grid_cells(grid, q[:, 0], q[:, 1])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # path length to the next x (y) cell boundary
+            dx, dy = d[sel, 0], d[sel, 1]
+            tmaxx[sel] = t0 + np.where(dx != 0, (lo[0] + cell * (ix[sel] + (dx > 0)) - q[:, 0]) / dx, np.inf)
+            tmaxy[sel] = t0 + np.where(dy != 0, (lo[1] + cell * (iy[sel] + (dy > 0)) - q[:, 1]) / dy, np.inf)
+        tin[sel] = t0
+
+    ix, iy = np.zeros(n, dtype=int), np.zeros(n, dtype=int)
+    tmaxx, tmaxy, tin = np.zeros(n), np.zeros(n), np.zeros(n)
+    restart(np.arange(n), np.zeros(n))
+
+    dist, edge = np.full(n, np.inf), np.full(n, -1)
+    todo = np.flatnonzero((d[:, 0] != 0) | (d[:, 1] != 0))
+    while len(todo):
+        c = ix[todo] * shape[1] + iy[todo]
+        # a ray two or more cells from any edge can safely jump that far less one
+        far = grid["empty"][c] >= 3
+        if far.any():
+            sel = todo[far]
+            restart(sel, tin[sel] + (grid["empty"][c[far]] - 2) * cell)
+            c = ix[todo] * shape[1] + iy[todo]
+
+        cand = grid["edges"][c]
+        instrument.add(stats, edge_tests=np.count_nonzero(cand >= 0))
+        a, b = start[cand], end[cand]
+        t, u, ok = segment_params(p[todo, None, :], d[todo, None, :], a, b - a)
+        tcell = np.minimum(tmaxx[todo], tmaxy[todo])
+        hit = ok & (cand >= 0) & (cand != skip[todo, None]) & (t > 0) & (t <= tcell[:, None]) & (u >= 0) & (u <= 1)
+        t = np.where(hit, t, np.inf)
+        k = np.argmin(t, axis=1)
+        best = t[np.arange(len(todo)), k]
+        found = np.isfinite(best)
+        dist[todo[found]] = best[found]
+        edge[todo[found]] = cand[found, k[found]]
+
+        rest = todo[~found]
+        xstep = tmaxx[rest] < tmaxy[rest]
+        tin[rest] = np.minimum(tmaxx[rest], tmaxy[rest])
+        ix[rest] += np.where(xstep, stepx[rest], 0)
+        iy[rest] += np.where(xstep, 0, stepy[rest])
+        tmaxx[rest] += np.where(xstep, tdeltax[rest], 0)
+        tmaxy[rest] += np.where(xstep, 0, tdeltay[rest])
+        ongrid = (ix[rest] >= 0) & (ix[rest] < shape[0]) & (iy[rest] >= 0) & (iy[rest] < shape[1])
+        todo = rest[ongrid]
+    return dist, edge
+
+
+def zwall_distances(pos, dirs, minz, maxz):
+    """Path length along each ray to the z wall it is heading for, inf if dz == 0."""
+    dz = dirs[:, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dist = np.where(dz > 0, (maxz - pos[:, 2]) / dz, np.where(dz < 0, (minz - pos[:, 2]) / dz, np.inf))
+    return np.maximum(dist, 0)
+
+
+def trace_rays(pos, dirs, stage, max_opl=np.inf, max_events=100000, crit_angle=np.pi/2, unfold_z=False, stats=None, fresnel=None):
+    """
+    Event driven tracer: rather than marching each ray by a fixed step, find
+    the exact distance to the next side or z wall and jump straight to it.
+    Cost scales with the number of reflections and the OPL is exact. Rays
+    whose OPL would pass max_opl are lost, which is the analogue of
+    sim_ray's max_steps * dl.
+
+    With unfold_z the z walls are ignored and only the in-plane motion is
+    traced; fold_z then puts the z walls back analytically. Counters go to
+    stats (see instrument.new_stats) if given. fresnel weights the rays as
+    in march_rays.
+    """
+    cstage = get_compiled(stage)
+    start, end, types, arcs = cstage["start"], cstage["end"], cstage["type"], cstage["arcs"]
+    minz, maxz = (-np.inf, np.inf) if unfold_z else cstage["zwalls"]
+    grid = cstage["grid"] if len(start) >= GRID_MIN_EDGES_EXACT else None
+
+    n = len(pos)
+    pos = np.array(pos, dtype=float)
+    dirs = normalise_rows(np.array(dirs, dtype=float))
+    status = np.full(n, ALIVE, dtype=np.int8)
+    opl = np.zeros(n)
+    bounces = np.zeros(n, dtype=np.int64)
+    weight = np.ones(n)
+    keys = ray_keys(pos, dirs) if fresnel is not None else None
+    lastedge = np.full(n, -1, dtype=np.int64)
+    ray_events, reflect_z = 0, 0
+    reflect_edge = np.zeros(len(start), dtype=np.int64)
+
+    active = np.arange(n)
+    events = 0
+    while len(active) and events < max_events:
+        events += 1
+        ray_events += len(active)
+        p, d = pos[active], dirs[active]
+        tside, edge = edge_distances(p, d, start, end, lastedge[active], grid, stats, arcs)
+        tz = zwall_distances(p, d, minz, maxz)
+        step = np.minimum(tside, tz)
+
+        nowall = ~np.isfinite(step)
+        toolong = nowall | (opl[active] + step > max_opl)
+        status[active[toolong]] = MAX_STEPS
+        status[active[nowall]] = NO_INTERSECTION
+        step[toolong] = 0
+
+        p = p + d * step[:, None]
+        opl[active] += step
+        onside = (tside <= tz) & ~toolong
+        onz = (tz < tside) & ~toolong
+
+        ## side walls
+        etype = types[edge]
+        status[active[onside & (etype == DETECTOR)]] = DETECTED
+        status[active[onside & (etype == DUMP)]] = DUMPED
+        sel = np.flatnonzero(onside & (etype == MIRROR))
+        wall = wall_normals(cstage, edge[sel], p[sel])
+        if fresnel is None:
+            tir = outside_crit_angle(d[sel], wall, crit_angle)
+        else:
+            tir = fresnel_survivors(d[sel], wall, fresnel, weight, keys, bounces, active[sel])
+        status[active[sel[~tir]]] = ESCAPED_SIDE
+        sel, wall = sel[tir], wall[tir]
+        np.add.at(reflect_edge, edge[sel], 1)
+        d[sel] = reflect_rays(d[sel], wall)
+        lastedge[active[sel]] = edge[sel]
+        bounces[active[sel]] += 1
+
+        ## z walls
+        sel = np.flatnonzero(onz)
+        wall = np.zeros((len(sel), 3))
+        wall[:, 2] = np.where(d[sel, 2] < 0, 1, -1)
+        if fresnel is None:
+            tir = outside_crit_angle(d[sel], wall, crit_angle)
+        else:
+            tir = fresnel_survivors(d[sel], wall, fresnel, weight, keys, bounces, active[sel])
+        status[active[sel[~tir]]] = ESCAPED_Z
+        sel, wall = sel[tir], wall[tir]
+        reflect_z += len(sel)
+        d[sel] = reflect_rays(d[sel], wall)
+        lastedge[active[sel]] = -1
+        bounces[active[sel]] += 1
+
+        pos[active], dirs[active] = p, d
+        active = active[status[active] == ALIVE]
+
+    status[active] = MAX_STEPS
+    instrument.add(stats, reflect_edge=reflect_edge, events=ray_events, reflect_z=reflect_z)
+    return {"status":status,
+            "detected":status == DETECTED,
+            "end":pos,
+            "enddir":dirs,
+            "opl":opl,
+            "bounces":bounces,
+            "weight":weight}
+
+
+def fold_z(pos, dirs, res, zwalls, crit_angle=np.pi/2, stats=None, fresnel=None):
+    """
+    Reconstruct the z motion of rays traced with trace_rays(unfold_z=True)
+    for the z walls zwalls. The side walls are vertical, so the in-plane
+    trace does not depend on z: between the z walls a ray just bounces with
+    constant |dz|, always reflecting or (inside the escape cone) escaping at
+    the first z wall it meets. pos and dirs are the launch positions (with z
+    inside zwalls) and directions of the rays in res. With fresnel (as for
+    the in-plane trace) no ray escapes at a z wall; its weight is scaled by
+    the reflectance of every z wall it meets, which with constant |dz| is
+    just a power. There is no roulette on the z walls, which cost nothing here.
+    """
+    minz, maxz = zwalls
+    h = maxz - minz
+    dz = normalise_rows(np.asarray(dirs, dtype=float))[:, 2]
+    status = res["status"].copy()
+    opl = res["opl"].copy()
+
+    ## escape cone rays leave at their first z wall, unless a side event comes first
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tz = np.where(dz > 0, maxz - pos[:, 2], pos[:, 2] - minz) / np.abs(dz)
+    escapes = (np.arcsin(np.clip(np.abs(dz), 0, 1)) <= crit_angle) & (dz != 0) & (fresnel is None)
+    out = escapes & (tz < opl) & (status != NO_INTERSECTION)
+    status[out] = ESCAPED_Z
+    opl[out] = tz[out]
+
+    ## unfold: z walls crossed, final height and sign of dz
+    w = pos[:, 2] - minz + dz * opl
+    crossed = np.floor(w / h)
+    m = w - 2 * h * np.floor(w / (2 * h))
+    zbounces = np.where(out, 0, np.abs(crossed)).astype(np.int64)
+    end = res["end"].copy()
+    end[:, 2] = minz + np.where(m <= h, m, 2 * h - m)
+    end[out] = np.nan
+    enddir = res["enddir"].copy()
+    enddir[:, 2] = np.where(crossed % 2 == 0, dz, -dz)
+    weight = res["weight"].copy()
+    if fresnel is not None:
+        weight *= fresnel_reflectance(np.asarray(dirs, dtype=float), np.tile([0., 0., 1.], (len(dz), 1)), *fresnel) ** zbounces
+    instrument.add(stats, reflect_z=zbounces.sum())
+    return {"status":status,
+            "detected":status == DETECTED,
+            "end":end,
+            "enddir":enddir,
+            "opl":opl,
+            "bounces":res["bounces"] + zbounces,
+            "zbounces":zbounces,
+            "weight":weight}